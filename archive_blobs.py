@@ -0,0 +1,128 @@
+""" Content-addressed store for large MIME parts of archived messages """
+
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+import os
+import re
+import email
+from hashlib import sha256
+
+BLOB_STUB = "[[gmail_archive blob sha256=%s size=%d]]"
+BLOB_STUB_PREFIX = "[[gmail_archive blob "
+RE_BLOB_STUB = re.compile(r"\[\[gmail_archive blob "
+                          r"sha256=([0-9a-f]{64}) size=(\d+)\]\]")
+
+
+class BlobStore(object):
+    """ Directory of blobs, each stored once in a file named after the
+        SHA-256 of its content (e.g. ab/cdef0123...).
+
+        Large MIME parts of a message can be moved into the store with
+        `externalize`, which replaces each of them by a one-line stub.
+        `reassemble` restores the exact original text. Parts are stored
+        in their transfer encoding (e.g. base64), exactly as they appear in
+        the message, so that identical attachments sent through the same
+        mailer are stored only once.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.stored_bytes = 0       # bytes written to new blobs
+        self.deduplicated_bytes = 0 # bytes of parts that were already stored
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def __contains__(self, digest):
+        return os.path.exists(self._path(digest))
+
+    def put(self, data):
+        """ Store `data` (unless it is already stored) and return its
+            SHA-256 hex digest
+        """
+        digest = sha256(data).hexdigest()
+        path = self._path(digest)
+        if os.path.exists(path):
+            self.deduplicated_bytes += len(data)
+            return digest
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmpfile = "%s.tmp%s" % (path, os.getpid())
+        blob_fh = open(tmpfile, "wb")
+        try:
+            blob_fh.write(data)
+        finally:
+            blob_fh.close()
+        os.rename(tmpfile, path)
+        self.stored_bytes += len(data)
+        return digest
+
+    def get(self, digest):
+        """ Return the content of the blob `digest`, or raise KeyError """
+        try:
+            blob_fh = open(self._path(digest), "rb")
+        except IOError:
+            raise KeyError('No blob with digest: %s' % digest)
+        try:
+            return blob_fh.read()
+        finally:
+            blob_fh.close()
+
+    def externalize(self, source, threshold):
+        """ Move every non-multipart MIME part of the raw message `source`
+            whose (encoded) body is at least `threshold` bytes into the
+            store, and return the message with those bodies replaced by
+            stubs
+        """
+        if BLOB_STUB_PREFIX in source:
+            # Can't tell our stubs from the text of the message
+            return source
+        pieces = []
+        pos = 0
+        for part in email.message_from_string(source).walk():
+            if part.is_multipart():
+                continue
+            payload = part.get_payload()
+            if len(payload) < threshold:
+                continue
+            start = source.find(payload, pos)
+            if start == -1:
+                continue
+            pieces.append(source[pos:start])
+            pieces.append(BLOB_STUB % (self.put(payload), len(payload)))
+            pos = start + len(payload)
+        if not pieces:
+            return source
+        pieces.append(source[pos:])
+        return "".join(pieces)
+
+    def reassemble(self, text):
+        """ Return `text` (an externalized message, as read back from an
+            archive) with all blob stubs replaced by the blob content
+        """
+        if BLOB_STUB_PREFIX not in text:
+            return text
+        def blob(match):
+            data = self.get(match.group(1))
+            if len(data) != int(match.group(2)):
+                raise ValueError("Blob %s is corrupted" % match.group(1))
+            return data
+        return RE_BLOB_STUB.sub(blob, text)
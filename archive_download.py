@@ -0,0 +1,305 @@
+""" Concurrent download of raw Gmail messages """
+
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+import sys
+import threading
+import Queue
+from collections import deque
+from time import time, sleep
+
+# threads that don't need loading which ThreadPrefetcher may take from the
+# listing ahead of the current thread, beyond its window
+SKIP_AHEAD = 8
+
+
+class DownloadPool(object):
+    """ Pool of worker threads that download the raw source of Gmail
+        messages concurrently.
+
+        Messages are queued with `submit`, and the downloaded sources are
+        handed back by `results` in the order in which the messages were
+        submitted, so that a single writer can archive them in a
+        deterministic order. At most `max_pending` messages are queued or
+        downloaded but not yet handed back (default: twice the number of
+        workers).
+
+        Downloads are started at least `min_interval` seconds apart, across
+        all workers. With `workers=0`, messages are downloaded in the
+        calling thread as they are submitted.
+
+        With `stream=True`, a download only sends the request, and the
+        "source" handed back is the open response (see
+        GmailMessage.openSource), from which the message is then read while
+        it is archived. The receiver must close it.
+    """
+
+    def __init__(self, workers=0, min_interval=0, max_pending=None,
+                 stream=False):
+        self.workers = workers
+        self.min_interval = min_interval
+        self.stream = stream
+        if max_pending is None:
+            max_pending = max(2 * workers, 1)
+        self.max_pending = max_pending
+        self._jobs = Queue.Queue()
+        self._results = {} # sequence number => (msg, data, exc_info, source)
+        self._cond = threading.Condition()
+        self._rate_lock = threading.Lock()
+        self._last_start = 0
+        self._next_submit = 0
+        self._next_result = 0
+        self._threads = []
+        for i in xrange(workers):
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True)
+            worker.start()
+            self._threads.append(worker)
+
+    def _wait_for_turn(self):
+        """ Sleep until the next download may be started """
+        self._rate_lock.acquire()
+        try:
+            delay = self._last_start + self.min_interval - time()
+            if delay > 0:
+                sleep(delay)
+            self._last_start = time()
+        finally:
+            self._rate_lock.release()
+
+    def _download(self, seq, gmail_msg, data):
+        self._wait_for_turn()
+        try:
+            if self.stream:
+                source = gmail_msg.openSource()
+            else:
+                source = gmail_msg.source
+            result = (gmail_msg, data, None, source)
+        except Exception:
+            result = (gmail_msg, data, sys.exc_info(), None)
+        self._cond.acquire()
+        try:
+            self._results[seq] = result
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            self._download(*job)
+
+    def pending(self):
+        """ Return the number of submitted messages not yet handed back """
+        return self._next_submit - self._next_result
+
+    def submit(self, gmail_msg, data=None):
+        """ Queue the download of `gmail_msg`. `data` is handed back
+            together with the message source.
+        """
+        seq = self._next_submit
+        self._next_submit += 1
+        if self.workers:
+            self._jobs.put((seq, gmail_msg, data))
+        else:
+            self._download(seq, gmail_msg, data)
+
+    def results(self, wait_all=False):
+        """ Yield (gmail_msg, data, source) for the downloaded messages in
+            the order in which they were submitted. Stops at the first
+            message that is still being downloaded, unless more than
+            `max_pending` messages are pending or `wait_all` is given, in
+            which case it waits for it. An exception raised by a download is
+            re-raised here.
+        """
+        while self.pending():
+            self._cond.acquire()
+            try:
+                while not self._results.has_key(self._next_result):
+                    if not (wait_all or self.pending() > self.max_pending):
+                        return
+                    # with a timeout, so that KeyboardInterrupt gets through
+                    self._cond.wait(1)
+                gmail_msg, data, exc_info, source = \
+                    self._results.pop(self._next_result)
+                self._next_result += 1
+            finally:
+                self._cond.release()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield gmail_msg, data, source
+
+    def close(self):
+        """ Stop the worker threads after their current download. Queued
+            downloads and results that have not been collected are
+            discarded (closing their responses, with `stream`).
+        """
+        try:
+            while True:
+                self._jobs.get_nowait()
+        except Queue.Empty:
+            pass
+        for worker in self._threads:
+            self._jobs.put(None)
+        self._threads = []
+        self._cond.acquire()
+        try:
+            results, self._results = self._results, {}
+        finally:
+            self._cond.release()
+        if self.stream:
+            for gmail_msg, data, exc_info, source in results.values():
+                if source is not None:
+                    source.close()
+
+
+class ThreadPrefetcher(object):
+    """ Iterates over a listing of Gmail threads while worker threads
+        retrieve the messages (the conversation view) of up to `window`
+        upcoming threads, so that the messages of a thread are usually
+        loaded by the time the thread is reached.
+
+        The threads are handed back in the order of the listing, which is
+        consumed in the iterating thread. Threads are loaded ahead only as
+        long as they have at most `max_messages` messages in total (but at
+        least one thread is always loaded ahead). The requests go through
+        the account's rate limiter like all others. With `window=0`, the
+        threads are handed back unchanged, and load their messages when
+        they are used.
+
+        Threads for which `needs_messages(thread)` returns False are handed
+        back in order without loading their messages. At most `window` +
+        SKIP_AHEAD threads are taken from the listing ahead of the current
+        one, so that a lazy listing isn't read to the end when most threads
+        are skipped.
+    """
+
+    def __init__(self, threads, window=4, max_messages=None,
+                 needs_messages=None):
+        self.window = window
+        self.max_messages = max_messages
+        self.needs_messages = needs_messages
+        self._threads = iter(threads)
+        self._held = None  # next thread of the listing, not submitted yet
+        self._ahead = deque() # (seq. number, thread, loaded)
+        self._loading = 0  # threads in `_ahead` that are being loaded
+        self._ahead_messages = 0
+        self._next_submit = 0
+        self._jobs = Queue.Queue()
+        self._results = {} # sequence number => exc_info or None
+        self._cond = threading.Condition()
+        self._workers = []
+        for i in xrange(window):
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            seq, thread = job
+            try:
+                thread.loadMessages()
+                exc_info = None
+            except Exception:
+                exc_info = sys.exc_info()
+            self._cond.acquire()
+            try:
+                self._results[seq] = exc_info
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+    def _fill(self):
+        """ Submit upcoming threads until the window or `max_messages` is
+            full, too many threads are ahead, or the listing ends
+        """
+        while self._loading < self.window \
+        and len(self._ahead) < self.window + SKIP_AHEAD:
+            if self._held is None:
+                try:
+                    self._held = self._threads.next()
+                except StopIteration:
+                    return
+            thread = self._held
+            load = self.needs_messages is None or self.needs_messages(thread)
+            if load and self._loading and self.max_messages is not None \
+            and self._ahead_messages + len(thread) > self.max_messages:
+                return
+            self._held = None
+            seq = self._next_submit
+            self._next_submit += 1
+            self._ahead.append((seq, thread, load))
+            if load:
+                self._loading += 1
+                self._ahead_messages += len(thread)
+                self._jobs.put((seq, thread))
+            else:
+                self._results[seq] = None
+
+    def __iter__(self):
+        """ Yield the threads of the listing with their messages loaded. An
+            exception raised while loading a thread is re-raised when the
+            thread is reached.
+        """
+        if not self.window:
+            for thread in self._threads:
+                yield thread
+            return
+        while True:
+            self._fill()
+            if not self._ahead:
+                return
+            seq, thread, loaded = self._ahead.popleft()
+            self._cond.acquire()
+            try:
+                while not self._results.has_key(seq):
+                    # with a timeout, so that KeyboardInterrupt gets through
+                    self._cond.wait(1)
+                exc_info = self._results.pop(seq)
+            finally:
+                self._cond.release()
+            if loaded:
+                self._loading -= 1
+                self._ahead_messages -= len(thread)
+            # start loading the next thread while this one is archived
+            self._fill()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield thread
+
+    def close(self):
+        """ Stop the worker threads after their current thread. Threads
+            that are queued are not loaded.
+        """
+        try:
+            while True:
+                self._jobs.get_nowait()
+        except Queue.Empty:
+            pass
+        for worker in self._workers:
+            self._jobs.put(None)
+        self._workers = []
@@ -0,0 +1,605 @@
+""" Sidecar index of the messages stored in an mbox archive """
+
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+import os
+import mmap
+import time
+from bisect import bisect_right
+from mailbox import mboxMessage
+
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = "# gmail_archive index"
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_MAGIC = "# gmail_archive journal"
+
+# Number of journal entries after which the mbox and journal are fsync'ed
+JOURNAL_SYNC_INTERVAL = 20
+
+# Files smaller than this are always scanned in a single process
+MIN_PARALLEL_SCAN_SIZE = 64 * 1024 * 1024
+
+# Buffer size for copying message data between files
+COPY_BUFSIZE = 1024 * 1024
+
+_FROM = "From "
+_SEPARATOR = os.linesep + _FROM
+_BLANK = os.linesep + os.linesep
+_GMAILID_HEADER = os.linesep + "X-GmailID:"
+
+
+def mbox_stamp(mboxfile):
+    """ Return (size, mtime) of `mboxfile`, or None if it doesn't exist. The
+        mtime is given as a string, so that it can be compared exactly to a
+        stamp read back from a file.
+    """
+    try:
+        stat = os.stat(mboxfile)
+    except OSError:
+        return None
+    return (stat.st_size, repr(stat.st_mtime))
+
+
+def mbox_chunks(source_fh, bufsize=COPY_BUFSIZE):
+    """ Yield the raw message read from `source_fh` in chunks of about
+        `bufsize` bytes, with line endings converted to os.linesep and every
+        line starting with 'From ' escaped as '>From ', like mailbox.mbox
+        does for a message given as a string.
+
+        A line ending or 'From ' split between two reads is still
+        recognized: only the last few bytes of each read are held back until
+        the next one.
+    """
+    pending = "\n" # the message starts at the start of a line
+    first = True
+    while True:
+        data = source_fh.read(bufsize)
+        text = (pending + data).replace("\r\n", "\n")
+        pending = ""
+        if data:
+            # hold back a trailing '\r' and a line break with less than a
+            # complete 'From ' after it
+            cut = text.rfind("\n", max(len(text) - len(_FROM), 0))
+            if text.endswith("\r") and cut == -1:
+                cut = len(text) - 1
+            if cut != -1:
+                text, pending = text[:cut], text[cut:]
+        text = text.replace("\n" + _FROM, "\n>" + _FROM)
+        if first and text:
+            text = text[1:]
+            first = False
+        if text:
+            yield text.replace("\n", os.linesep)
+        if not data:
+            return
+
+
+def append_message(mbox_fh, source_fh, header="", bufsize=COPY_BUFSIZE):
+    """ Append the raw message read from `source_fh` to the end of the mbox
+        file `mbox_fh` (open for reading and writing) and return its
+        (offset, length), without holding the message in memory. `header`
+        (e.g. "X-GmailID: ...\n") is written in front of the message's own
+        headers.
+
+        The message is written the way mailbox.mbox writes it: a 'From '
+        line, the message copied in chunks (see `mbox_chunks`) and a blank
+        line; the offset and length are those that `scan_mbox` finds for
+        it. mailbox.mbox itself is not used, because it reads the whole
+        file to build its table of contents before it adds a message. If
+        writing fails, the file is truncated to its former end.
+    """
+    mbox_fh.seek(0, 2)
+    start = mbox_fh.tell()
+    try:
+        mbox_fh.write("From MAILER-DAEMON %s%s"
+                      % (time.asctime(time.gmtime()), os.linesep))
+        mbox_fh.write(header.replace("\n", os.linesep))
+        chunk = os.linesep
+        for chunk in mbox_chunks(source_fh, bufsize):
+            mbox_fh.write(chunk)
+        if not chunk.endswith(os.linesep):
+            mbox_fh.write(os.linesep)
+        stop = mbox_fh.tell()
+        mbox_fh.write(os.linesep)
+        mbox_fh.flush()
+    except BaseException:
+        mbox_fh.truncate(start)
+        raise
+    return start, stop - start
+
+
+def _open_mmap(mboxfile):
+    """ Return (file handle, read-only mmap) for `mboxfile`, or (None, None)
+        if the file is empty
+    """
+    mbox_fh = open(mboxfile, "rb")
+    if os.fstat(mbox_fh.fileno()).st_size == 0:
+        mbox_fh.close()
+        return None, None
+    return mbox_fh, mmap.mmap(mbox_fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _copy_range(src_fh, dst_fh, start, stop, bufsize=COPY_BUFSIZE):
+    """ Copy the bytes [start, stop) of `src_fh` to the current position of
+        `dst_fh`
+    """
+    src_fh.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        buffer = src_fh.read(min(bufsize, remaining))
+        if not buffer:
+            break
+        dst_fh.write(buffer)
+        remaining -= len(buffer)
+
+
+def _next_message_start(mm, pos):
+    """ Return the offset of the first 'From ' line starting at or after
+        `pos` in `mm`, or the size of `mm` if there is none
+    """
+    if pos == 0 and mm[:len(_FROM)] == _FROM:
+        return 0
+    start = mm.find(_SEPARATOR, max(pos - len(os.linesep), 0))
+    if start == -1:
+        return mm.size()
+    return start + len(os.linesep)
+
+
+def _message_gmail_id(mm, start, stop):
+    """ Return the X-GmailID of the message [start, stop) of `mm`, or None
+        if it has none
+    """
+    header_end = mm.find(_BLANK, start, stop)
+    if header_end == -1:
+        header_end = stop
+    pos = mm.rfind(_GMAILID_HEADER, start, header_end)
+    if pos == -1:
+        return None
+    pos += len(_GMAILID_HEADER)
+    eol = mm.find(os.linesep, pos, stop)
+    if eol == -1:
+        eol = stop
+    return mm[pos:eol].strip() or None
+
+
+def _is_message_at(mm, gmail_id, offset, length):
+    """ Return True if the message `gmail_id` is stored at [offset, offset +
+        length) of `mm`: it starts with a 'From ' line, carries that
+        X-GmailID, and is followed by a blank line and the next message or
+        the end of the file
+    """
+    sep_len = len(os.linesep)
+    stop = offset + length
+    if offset < 0 or stop + sep_len > mm.size():
+        return False
+    if mm[offset:offset + len(_FROM)] != _FROM \
+    or mm[stop:stop + sep_len] != os.linesep:
+        return False
+    if stop + sep_len < mm.size() \
+    and mm[stop + sep_len:stop + sep_len + len(_FROM)] != _FROM:
+        return False
+    return _message_gmail_id(mm, offset, stop) == gmail_id
+
+
+def _scan_range(args):
+    """ Scan the messages that start in the byte range [begin, end) of the
+        mbox file and return a list of (gmail_id, offset, length) tuples.
+
+        Only the 'From ' separators and the X-GmailID header are looked at;
+        the message boundaries are identical to those found by
+        mailbox.mbox.
+    """
+    mboxfile, begin, end = args
+    result = []
+    mbox_fh, mm = _open_mmap(mboxfile)
+    if mm is None:
+        return result
+    try:
+        sep_len = len(os.linesep)
+        start = _next_message_start(mm, begin)
+        while start < end and start < mm.size():
+            boundary = _next_message_start(mm, start + len(_FROM))
+            if mm[boundary - 2 * sep_len:boundary] == _BLANK:
+                stop = boundary - sep_len
+            else:
+                stop = boundary
+            gmail_id = _message_gmail_id(mm, start, stop)
+            if gmail_id:
+                result.append((gmail_id, start, stop - start))
+            start = boundary
+    finally:
+        mm.close()
+        mbox_fh.close()
+    return result
+
+
+def scan_mbox(mboxfile, processes=None):
+    """ Return dict mapping the X-GmailID of every message in `mboxfile` to
+        the (offset, length) of that message, without parsing the messages.
+
+        The file is memory-mapped and searched for message separators and
+        X-GmailID headers only. Files larger than MIN_PARALLEL_SCAN_SIZE are
+        split into byte ranges that are scanned by a pool of `processes`
+        worker processes (default: one per CPU).
+    """
+    try:
+        size = os.path.getsize(mboxfile)
+    except OSError:
+        return {}
+    if processes is None:
+        try:
+            import multiprocessing
+            processes = multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            processes = 1
+    if processes <= 1 or size < MIN_PARALLEL_SCAN_SIZE:
+        entries = _scan_range((mboxfile, 0, size))
+    else:
+        import multiprocessing
+        chunk = size // processes + 1
+        ranges = [(mboxfile, begin, min(begin + chunk, size))
+                  for begin in xrange(0, size, chunk)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            entries = []
+            for range_entries in pool.map(_scan_range, ranges):
+                entries.extend(range_entries)
+        finally:
+            pool.close()
+            pool.join()
+    offsets = {}
+    for gmail_id, offset, length in entries:
+        offsets[gmail_id] = (offset, length)
+    return offsets
+
+
+class MboxIndex(object):
+    """ Map of the X-GmailID of every message in an mbox file to the byte
+        offset and length of that message.
+
+        The index is stored in a sidecar file next to the mbox (MBOXFILE.idx
+        by default), together with the size and modification time of the
+        mbox at the time the index was written. An index whose recorded
+        size/mtime doesn't match the mbox on disk is considered stale and
+        must be rebuilt.
+    """
+
+    def __init__(self, mboxfile, indexfile=None):
+        self.mboxfile = mboxfile
+        if indexfile is None:
+            indexfile = mboxfile + INDEX_SUFFIX
+        self.indexfile = indexfile
+        self.offsets = {} # gmail_id => (offset, length)
+
+    def __contains__(self, gmail_id):
+        return gmail_id in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def load(self, stamp=None):
+        """ Read the index from disk. Return True if the index is valid for
+            the current mbox file, False if it is missing or stale (in which
+            case the index is left empty).
+
+            If `stamp` is given, the index is accepted if it was written
+            for an mbox with that (size, mtime) stamp instead.
+        """
+        self.offsets = {}
+        if stamp is None:
+            stamp = mbox_stamp(self.mboxfile)
+        if stamp is None:
+            return False
+        try:
+            index_fh = open(self.indexfile)
+        except IOError:
+            return False
+        try:
+            header = index_fh.readline().split()
+            if " ".join(header[:-2]) != INDEX_MAGIC \
+            or (int(header[-2]), header[-1]) != stamp:
+                return False
+            offsets = {}
+            for line in index_fh:
+                gmail_id, offset, length = line.split()
+                offsets[gmail_id] = (int(offset), int(length))
+        except (ValueError, IndexError):
+            return False
+        finally:
+            index_fh.close()
+        self.offsets = offsets
+        return True
+
+    def save(self, mboxfile=None):
+        """ Write the index to disk, stamped with the current size and
+            modification time of the mbox file (or of `mboxfile`, which is
+            about to replace it). The index file is replaced atomically.
+        """
+        stamp = mbox_stamp(mboxfile or self.mboxfile)
+        if stamp is None:
+            return
+        tmpfile = "%s.tmp%s" % (self.indexfile, os.getpid())
+        index_fh = open(tmpfile, "w")
+        try:
+            index_fh.write("%s %s %s\n" % (INDEX_MAGIC, stamp[0], stamp[1]))
+            for gmail_id, (offset, length) in self.offsets.iteritems():
+                index_fh.write("%s %s %s\n" % (gmail_id, offset, length))
+        finally:
+            index_fh.close()
+        os.rename(tmpfile, self.indexfile)
+
+    def rebuild(self, processes=None):
+        """ Rebuild the index from scratch by scanning the mbox file (see
+            `scan_mbox`)
+        """
+        self.offsets = scan_mbox(self.mboxfile, processes)
+
+    def add(self, gmail_id, offset, length):
+        """ Record that the message `gmail_id` is stored at the given byte
+            `offset` with the given `length`
+        """
+        self.offsets[gmail_id] = (offset, length)
+
+    def remove(self, gmail_id):
+        """ Drop `gmail_id` from the index """
+        del self.offsets[gmail_id]
+
+    def compact(self, stale_ids):
+        """ Remove the messages `stale_ids` from the mbox file in a single
+            streaming pass and return the number of bytes reclaimed.
+
+            All surviving byte ranges are copied to a temporary file that
+            then atomically replaces the mbox. The index, with the offsets
+            of the remaining messages shifted accordingly, is saved for the
+            new file before the rename, so that it is never valid for the
+            wrong file if the compaction is interrupted. The mbox must not
+            have unflushed changes, and the index must be valid.
+        """
+        sep_len = len(os.linesep)
+        mbox_fh = open(self.mboxfile, "rb")
+        try:
+            size = os.fstat(mbox_fh.fileno()).st_size
+            # Each removed span includes the blank line after the message
+            spans = []
+            for gmail_id in stale_ids:
+                offset, length = self.offsets[gmail_id]
+                stop = offset + length
+                mbox_fh.seek(stop)
+                if mbox_fh.read(sep_len) == os.linesep:
+                    stop += sep_len
+                spans.append((offset, stop))
+            if not spans:
+                return 0
+            spans.sort()
+            tmpfile = "%s.tmp%s" % (self.mboxfile, os.getpid())
+            new_fh = open(tmpfile, "wb")
+            try:
+                pos = 0
+                for start, stop in spans:
+                    _copy_range(mbox_fh, new_fh, pos, start)
+                    pos = stop
+                _copy_range(mbox_fh, new_fh, pos, size)
+                new_fh.flush()
+                os.fsync(new_fh.fileno())
+            except:
+                new_fh.close()
+                os.remove(tmpfile)
+                raise
+            new_fh.close()
+        finally:
+            mbox_fh.close()
+        # shift the offsets of the surviving messages
+        starts = [start for start, stop in spans]
+        removed_before = [0]
+        for start, stop in spans:
+            removed_before.append(removed_before[-1] + stop - start)
+        stale_ids = set(stale_ids)
+        old_offsets, self.offsets = self.offsets, {}
+        for gmail_id, (offset, length) in old_offsets.iteritems():
+            if gmail_id not in stale_ids:
+                shift = removed_before[bisect_right(starts, offset)]
+                self.offsets[gmail_id] = (offset - shift, length)
+        try:
+            os.chmod(tmpfile, os.stat(self.mboxfile).st_mode)
+            self.save(tmpfile)
+        except:
+            self.offsets = old_offsets
+            os.remove(tmpfile)
+            raise
+        os.rename(tmpfile, self.mboxfile)
+        return removed_before[-1]
+
+    def read(self, gmail_id):
+        """ Return the raw text (including the 'From ' line) of the message
+            stored under `gmail_id`, or raise KeyError
+        """
+        offset, length = self.offsets[gmail_id]
+        mbox_fh = open(self.mboxfile, "rb")
+        try:
+            mbox_fh.seek(offset)
+            return mbox_fh.read(length)
+        finally:
+            mbox_fh.close()
+
+    def get_message(self, gmail_id):
+        """ Return the message stored under `gmail_id` as an mboxMessage,
+            or raise KeyError
+        """
+        from_line, string = self.read(gmail_id).split(os.linesep, 1)
+        msg = mboxMessage(string.replace(os.linesep, '\n'))
+        msg.set_from(from_line[5:])
+        return msg
+
+
+class MboxJournal(object):
+    """ Append-only journal of the messages appended to an indexed mbox file
+        since its index was last saved.
+
+        The journal starts with the (size, mtime) stamp of the mbox for which
+        the index was saved, followed by one "gmail_id offset length" line
+        per appended message. The mbox and the journal are fsync'ed every
+        `sync_interval` entries, mbox first, so that every synced journal
+        entry refers to message data that is on disk.
+
+        If a run is killed before the index is saved, `recover` brings the
+        saved index up to date by replaying the journal, and cuts off any
+        partially written message at the end of the mbox. Every journaled
+        message is checked in the mbox first, so that an mbox that was
+        changed by anything else is never "recovered". The journal is
+        deleted with `discard` once the index has been saved.
+    """
+
+    def __init__(self, mboxfile, journalfile=None,
+                 sync_interval=JOURNAL_SYNC_INTERVAL):
+        self.mboxfile = mboxfile
+        if journalfile is None:
+            journalfile = mboxfile + JOURNAL_SUFFIX
+        self.journalfile = journalfile
+        self.sync_interval = sync_interval
+        self._journal_fh = None
+        self._mbox_fh = None
+        self._unsynced = 0
+
+    def recover(self, index):
+        """ Load `index` as saved before the journal was started and apply
+            the journal entries to it, truncating the mbox after the last
+            complete journaled message. Return False if the journal or index
+            can't be used, in which case the index must be rebuilt.
+
+            The journal is only used if the mbox is the one the index was
+            saved for plus the journaled messages, each at its recorded
+            offset with its X-GmailID, followed by nothing but messages of
+            ours (with an X-GmailID) that were appended after the last
+            journal sync.
+        """
+        try:
+            journal_fh = open(self.journalfile)
+        except IOError:
+            return False
+        try:
+            header = journal_fh.readline().split()
+            if " ".join(header[:-2]) != JOURNAL_MAGIC:
+                return False
+            try:
+                stamp = (int(header[-2]), header[-1])
+            except (ValueError, IndexError):
+                return False
+            entries = []
+            for line in journal_fh:
+                if not line.endswith("\n"):
+                    break # half-written entry
+                try:
+                    gmail_id, offset, length = line.split()
+                    entries.append((gmail_id, int(offset), int(length)))
+                except ValueError:
+                    break
+        finally:
+            journal_fh.close()
+        if not index.load(stamp):
+            return False
+        mbox_fh, mm = _open_mmap(self.mboxfile)
+        if mm is None:
+            return False
+        try:
+            size = mm.size()
+            if size <= stamp[0]:
+                # Nothing of ours was appended, so someone else changed it
+                return False
+            # The last message of the saved index must still be in place
+            if index.offsets:
+                last = max(index.offsets.iteritems(),
+                           key=lambda item: item[1][0])
+                if not _is_message_at(mm, last[0], *last[1]):
+                    return False
+            end = stamp[0]
+            for gmail_id, offset, length in entries:
+                if offset != end or not _is_message_at(mm, gmail_id,
+                                                       offset, length):
+                    return False
+                index.add(gmail_id, offset, length)
+                end = offset + length + len(os.linesep)
+            if end < size:
+                # Only our own, unjournaled messages may follow
+                if mm[end:end + len(_FROM)] != _FROM:
+                    return False
+                start = end
+                while start < size:
+                    boundary = _next_message_start(mm, start + len(_FROM))
+                    if _message_gmail_id(mm, start, boundary) is None:
+                        return False
+                    start = boundary
+        finally:
+            mm.close()
+            mbox_fh.close()
+        if size > end:
+            mbox_fh = open(self.mboxfile, "rb+")
+            try:
+                mbox_fh.truncate(end)
+            finally:
+                mbox_fh.close()
+        return True
+
+    def start(self):
+        """ Start a new, empty journal for the mbox in its current state """
+        self.close()
+        stamp = mbox_stamp(self.mboxfile)
+        journal_fh = open(self.journalfile, "w")
+        journal_fh.write("%s %s %s\n" % (JOURNAL_MAGIC, stamp[0], stamp[1]))
+        journal_fh.flush()
+        os.fsync(journal_fh.fileno())
+        self._journal_fh = journal_fh
+        self._mbox_fh = open(self.mboxfile, "rb")
+        self._unsynced = 0
+
+    def record(self, gmail_id, offset, length):
+        """ Record that the message `gmail_id` was appended to the mbox at
+            `offset` with the given `length`
+        """
+        self._journal_fh.write("%s %s %s\n" % (gmail_id, offset, length))
+        self._unsynced += 1
+        if self._unsynced >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """ Flush the mbox and the journal to disk """
+        if self._journal_fh is None:
+            return
+        os.fsync(self._mbox_fh.fileno())
+        self._journal_fh.flush()
+        os.fsync(self._journal_fh.fileno())
+        self._unsynced = 0
+
+    def discard(self):
+        """ Close and delete the journal, once the index is saved """
+        self.close()
+        try:
+            os.remove(self.journalfile)
+        except OSError:
+            pass
+
+    def close(self):
+        """ Sync and close the journal """
+        if self._journal_fh is not None:
+            self.sync()
+            self._journal_fh.close()
+            self._mbox_fh.close()
+            self._journal_fh = None
+            self._mbox_fh = None
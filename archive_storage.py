@@ -0,0 +1,777 @@
+""" Storage backends for archived Gmail messages """
+
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+import os
+import re
+import errno
+import urllib
+import thread
+import sqlite3
+from cStringIO import StringIO
+from mailbox import mbox, mboxMessage
+from email.utils import parsedate_tz
+from archive_index import MboxIndex, MboxJournal, mbox_stamp, \
+     append_message, COPY_BUFSIZE
+from archive_blobs import BlobStore
+
+BLOBS_SUFFIX = ".blobs"
+SHARD_SUFFIX = ".mbox"
+MANIFEST_NAME = "MANIFEST"
+MANIFEST_MAGIC = "# gmail_archive manifest"
+SHARD_BY = ('month', 'label')
+FORMATS = ('mbox', 'maildir', 'sqlite')
+# the blank line that ends the headers of a message, with LF or CRLF
+_BLANK_LINE = re.compile(r"\r?\n\r?\n")
+
+
+class ArchiveStore(object):
+    """ Interface of all storage backends for archived messages.
+
+        A store is opened with `open` before use and must be closed with
+        `close`, which makes all changes permanent. Messages are identified
+        by their Gmail ID (a str).
+    """
+
+    def open(self):
+        """ Prepare the store for use, e.g. acquire locks, load indexes """
+        raise NotImplementedError
+
+    def __contains__(self, gmail_id):
+        """ Return True if the message `gmail_id` is archived """
+        raise NotImplementedError
+
+    def ids(self):
+        """ Return an iterable of the Gmail IDs of all archived messages """
+        raise NotImplementedError
+
+    def searched_ids(self, search_labels):
+        """ Return an iterable of the Gmail IDs of the archived messages
+            that searches for `search_labels` (the labels of the searches,
+            if any) archive, i.e. those that may be removed if the searches
+            no longer find them. By default, these are all messages.
+        """
+        return self.ids()
+
+    def add(self, gmail_id, source, labels=None, info=None):
+        """ Archive the raw message `source` under `gmail_id`. `labels` is
+            the list of labels of the message, if known. `info` is an
+            optional dict of metadata ('thread_id', 'date', 'sender',
+            'subject') that backends may store alongside the message.
+        """
+        raise NotImplementedError
+
+    def add_stream(self, gmail_id, source_fh, labels=None, info=None):
+        """ Archive the raw message read from the file-like `source_fh`
+            under `gmail_id`, like `add`. Backends that can write a message
+            piecewise override this, so that the message is never held in
+            memory as a whole; by default it is read completely and passed
+            to `add`.
+        """
+        self.add(gmail_id, source_fh.read(), labels, info)
+
+    def read(self, gmail_id):
+        """ Return the raw message archived under `gmail_id` as it is
+            stored (e.g. with the X-GmailID header that mbox and Maildir
+            archives add), or raise KeyError
+        """
+        raise NotImplementedError
+
+    def record_thread(self, thread_id, labels, gmail_ids):
+        """ Record that the thread `thread_id` with the given `labels`
+            consists of the messages `gmail_ids`. Backends that don't keep
+            thread information ignore this.
+        """
+        pass
+
+    def remove(self, stale_ids):
+        """ Remove the messages `stale_ids` from the archive and return the
+            number of bytes reclaimed
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """ Write all pending changes and release the store """
+        raise NotImplementedError
+
+
+class MboxStore(ArchiveStore):
+    """ Archive in a single mbox file, with a sidecar index of the
+        X-GmailIDs it contains (see archive_index.MboxIndex). Messages added
+        since the index was last saved are recorded in a journal, so that
+        the index can be recovered quickly after a crash.
+
+        Messages are appended to the file directly (see
+        archive_index.append_message); mailbox.mbox is only used to lock
+        the file.
+    """
+
+    def __init__(self, mboxfile, scan_processes=None, verbose=False):
+        self.mboxfile = mboxfile
+        self.scan_processes = scan_processes
+        self.verbose = verbose
+        self.mbox = None
+        self._mbox_fh = None
+        self.index = MboxIndex(mboxfile)
+        self.journal = MboxJournal(mboxfile)
+
+    def open(self):
+        """ Open and lock the mbox file, load its index (recovering it from
+            the journal or rebuilding it, if necessary) and start a new
+            journal
+        """
+        self._open_mbox()
+        if not self.index.load():
+            if self.journal.recover(self.index):
+                if self.verbose:
+                    print "Recovered index %s from journal" \
+                          % self.index.indexfile
+            else:
+                if self.verbose:
+                    print "Rebuilding index %s" % self.index.indexfile
+                self.index.rebuild(self.scan_processes)
+            self.index.save()
+        self.journal.start()
+
+    def _open_mbox(self):
+        """ Lock the mbox file (creating it if necessary) and open it for
+            appending messages
+        """
+        self.mbox = mbox(self.mboxfile)
+        self.mbox.lock()
+        self._mbox_fh = open(self.mboxfile, "rb+")
+
+    def _close_mbox(self):
+        self._mbox_fh.close()
+        self._mbox_fh = None
+        self.mbox.close()
+
+    def __contains__(self, gmail_id):
+        return gmail_id in self.index
+
+    def ids(self):
+        """ Return an iterable of the Gmail IDs of all archived messages """
+        return self.index.offsets.iterkeys()
+
+    def add(self, gmail_id, source, labels=None, info=None):
+        """ Archive the raw message `source` under `gmail_id`, exactly as
+            `add_stream` does
+        """
+        self.add_stream(gmail_id, StringIO(source), labels, info)
+
+    def add_stream(self, gmail_id, source_fh, labels=None, info=None):
+        """ Append the raw message read from `source_fh` to the mbox in
+            chunks, with the X-GmailID header in front of its headers
+        """
+        offset, length = append_message(self._mbox_fh, source_fh,
+                                        "X-GmailID: %s\n" % gmail_id)
+        self.index.add(gmail_id, offset, length)
+        self.journal.record(gmail_id, offset, length)
+
+    def read(self, gmail_id):
+        """ Return the archived message `gmail_id` without its 'From '
+            line, as mailbox.mbox.get_string does
+        """
+        return self.index.read(gmail_id).split(os.linesep, 1)[1]
+
+    def remove(self, stale_ids):
+        """ Remove the messages `stale_ids` from the archive and return the
+            number of bytes reclaimed
+        """
+        self.journal.close()
+        self._close_mbox()
+        try:
+            reclaimed = self.index.compact(stale_ids)
+        finally:
+            # the mbox file has been replaced, so it must be opened again
+            self._open_mbox()
+        self.index.save()
+        self.journal.start()
+        return reclaimed
+
+    def close(self):
+        """ Flush and unlock the mbox file, save its index and delete the
+            journal
+        """
+        self.journal.close()
+        self._close_mbox()
+        self.index.save()
+        self.journal.discard()
+
+
+class _PrefixedFile(object):
+    """ File-like object that reads `prefix` and then the rest of `fh` """
+
+    def __init__(self, prefix, fh):
+        self._prefix = prefix
+        self._fh = fh
+
+    def read(self, size=-1):
+        if size < 0:
+            data, self._prefix = self._prefix + self._fh.read(), ""
+            return data
+        if not self._prefix:
+            return self._fh.read(size)
+        data, self._prefix = self._prefix[:size], self._prefix[size:]
+        return data
+
+
+def _read_headers(source_fh):
+    """ Read the header lines of a raw message (up to and including the
+        blank line that ends them) from `source_fh` and return them
+    """
+    lines = []
+    while True:
+        line = source_fh.readline()
+        lines.append(line)
+        if not line.strip():
+            return "".join(lines)
+
+
+def _message_month(source):
+    """ Return the 'YYYY-MM' month of the Date header of the raw message
+        `source`, or 'undated'
+    """
+    headers = _BLANK_LINE.split(source, 1)[0]
+    date = mboxMessage(headers)['Date']
+    if date is not None:
+        date = parsedate_tz(date)
+    if not date:
+        return "undated"
+    return "%04d-%02d" % (date[0], date[1])
+
+
+def _label_shard(label):
+    """ Return the name of the shard for `label`, which is unicode (from
+        Gmail) or a UTF-8 encoded str (from the command line)
+    """
+    if isinstance(label, unicode):
+        label = label.encode('utf-8')
+    return urllib.quote(label, safe='')
+
+
+class ShardedMboxStore(ArchiveStore):
+    """ Archive split over several mbox files ("shards") in a directory,
+        one per month (e.g. 2009-06.mbox) or one per label.
+
+        Every shard is an MboxStore with its own index. A manifest in the
+        directory records which shard holds which Gmail ID, together with
+        the size and mtime of each shard, so that the archived IDs can be
+        determined without opening the shards. Shards are only opened (and
+        locked) when messages are added to or removed from them.
+    """
+
+    def __init__(self, directory, shard_by='month', scan_processes=None,
+                 verbose=False):
+        if shard_by not in SHARD_BY:
+            raise ValueError("shard_by must be one of %s" % (SHARD_BY,))
+        self.directory = directory
+        self.shard_by = shard_by
+        self.scan_processes = scan_processes
+        self.verbose = verbose
+        self.manifest = os.path.join(directory, MANIFEST_NAME)
+        self.shard_of = {} # gmail_id => shard name
+        self._stores = {} # shard name => open MboxStore
+
+    def _shard_file(self, shard):
+        return os.path.join(self.directory, shard + SHARD_SUFFIX)
+
+    def _shards_on_disk(self):
+        return [filename[:-len(SHARD_SUFFIX)]
+                for filename in os.listdir(self.directory)
+                if filename.endswith(SHARD_SUFFIX)]
+
+    def _read_manifest(self):
+        """ Return ({shard: stamp}, {shard: [gmail_ids]}) from the manifest
+            file, or two empty dicts if it is missing or unreadable
+        """
+        stamps = {}
+        ids = {}
+        try:
+            manifest_fh = open(self.manifest)
+        except IOError:
+            return {}, {}
+        try:
+            if manifest_fh.readline().strip() != MANIFEST_MAGIC:
+                return {}, {}
+            for line in manifest_fh:
+                fields = line.split()
+                if fields[0] == "@":
+                    stamps[fields[1]] = (int(fields[2]), fields[3])
+                else:
+                    ids.setdefault(fields[1], []).append(fields[0])
+        except (ValueError, IndexError):
+            return {}, {}
+        finally:
+            manifest_fh.close()
+        return stamps, ids
+
+    def _write_manifest(self):
+        ids = {}
+        for gmail_id, shard in self.shard_of.iteritems():
+            ids.setdefault(shard, []).append(gmail_id)
+        tmpfile = "%s.tmp%s" % (self.manifest, os.getpid())
+        manifest_fh = open(tmpfile, "w")
+        try:
+            manifest_fh.write("%s\n" % MANIFEST_MAGIC)
+            for shard in self._shards_on_disk():
+                stamp = mbox_stamp(self._shard_file(shard))
+                manifest_fh.write("@ %s %s %s\n" % (shard, stamp[0], stamp[1]))
+                for gmail_id in ids.get(shard, []):
+                    manifest_fh.write("%s %s\n" % (gmail_id, shard))
+        finally:
+            manifest_fh.close()
+        os.rename(tmpfile, self.manifest)
+
+    def open(self):
+        """ Determine the archived IDs from the manifest. Shards that have
+            changed since the manifest was written are opened, and looked up
+            in their own index instead.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        stamps, manifest_ids = self._read_manifest()
+        self.shard_of = {}
+        for shard in self._shards_on_disk():
+            shard_file = self._shard_file(shard)
+            if stamps.get(shard) == mbox_stamp(shard_file):
+                ids = manifest_ids.get(shard, [])
+            else:
+                ids = list(self._store(shard).ids())
+            for gmail_id in ids:
+                self.shard_of[gmail_id] = shard
+
+    def _store(self, shard):
+        """ Return the opened MboxStore for `shard` """
+        if not self._stores.has_key(shard):
+            store = MboxStore(self._shard_file(shard), self.scan_processes,
+                              self.verbose)
+            store.open()
+            self._stores[shard] = store
+        return self._stores[shard]
+
+    def _route(self, source, labels):
+        """ Return the name of the shard for a message, given its `source`
+            (or only the headers of it)
+        """
+        if self.shard_by == 'month':
+            return _message_month(source)
+        if labels:
+            return _label_shard(labels[0])
+        return "unlabeled"
+
+    def __contains__(self, gmail_id):
+        return gmail_id in self.shard_of
+
+    def ids(self):
+        """ Return an iterable of the Gmail IDs of all archived messages """
+        return self.shard_of.iterkeys()
+
+    def searched_ids(self, search_labels):
+        """ Return the Gmail IDs archived in the shards of `search_labels`
+            if the archive is split by label, or all IDs. Messages found by
+            searches without a label are archived in the shard of their own
+            first label, so messages in other shards are never included.
+        """
+        if self.shard_by != 'label':
+            return self.ids()
+        shards = set([_label_shard(label) for label in search_labels])
+        return [gmail_id for gmail_id, shard in self.shard_of.iteritems()
+                if shard in shards]
+
+    def add(self, gmail_id, source, labels=None, info=None):
+        """ Archive the raw message `source` under `gmail_id` in the shard
+            for its month, or for the first of its `labels`
+        """
+        shard = self._route(source, labels)
+        self._store(shard).add(gmail_id, source, labels, info)
+        self.shard_of[gmail_id] = shard
+
+    def add_stream(self, gmail_id, source_fh, labels=None, info=None):
+        """ Stream the raw message read from `source_fh` into its shard.
+            Only the headers are read ahead, to route the message by month.
+        """
+        headers = ""
+        if self.shard_by == 'month':
+            headers = _read_headers(source_fh)
+        shard = self._route(headers, labels)
+        self._store(shard).add_stream(gmail_id,
+                                      _PrefixedFile(headers, source_fh),
+                                      labels, info)
+        self.shard_of[gmail_id] = shard
+
+    def read(self, gmail_id):
+        return self._store(self.shard_of[gmail_id]).read(gmail_id)
+
+    def remove(self, stale_ids):
+        """ Remove the messages `stale_ids` from the shards holding them and
+            return the number of bytes reclaimed
+        """
+        by_shard = {}
+        for gmail_id in stale_ids:
+            by_shard.setdefault(self.shard_of[gmail_id], []).append(gmail_id)
+        reclaimed = 0
+        for shard, shard_ids in by_shard.iteritems():
+            reclaimed += self._store(shard).remove(shard_ids)
+            for gmail_id in shard_ids:
+                del self.shard_of[gmail_id]
+        return reclaimed
+
+    def close(self):
+        """ Close all opened shards and write the manifest """
+        try:
+            for store in self._stores.values():
+                store.close()
+        finally:
+            self._stores = {}
+            self._write_manifest()
+
+
+class MaildirStore(ArchiveStore):
+    """ Archive in a Maildir directory, with one file per message, named
+        after its Gmail ID.
+
+        Messages are written to tmp/ and then renamed into new/, so a message
+        file is either complete or not there at all. There is no global
+        lock: any number of threads or processes may add messages
+        concurrently. The files are listed once by `open`; checking whether
+        a message is archived looks at that listing, and only at new/ and
+        cur/ for a file of that exact name. Mail clients may move files to
+        cur/ and append flags to the file name; such files are still
+        recognized.
+    """
+
+    def __init__(self, directory, verbose=False):
+        self.directory = directory
+        self.verbose = verbose
+        self._paths = {} # gmail_id => path of message file
+
+    def open(self):
+        """ Create the Maildir if necessary and list the archived messages """
+        for subdir in ('tmp', 'new', 'cur'):
+            path = os.path.join(self.directory, subdir)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self._list_messages()
+
+    def _list_messages(self):
+        """ Find the files of all messages in new/ and cur/ """
+        self._paths = {}
+        for subdir in ('new', 'cur'):
+            path = os.path.join(self.directory, subdir)
+            for filename in os.listdir(path):
+                gmail_id = filename.split(':', 1)[0]
+                self._paths[gmail_id] = os.path.join(path, filename)
+
+    def __contains__(self, gmail_id):
+        if gmail_id in self._paths:
+            return True
+        # The message may have been added by another process (and moved to
+        # cur/ by a mail client) since the listing
+        for subdir in ('new', 'cur'):
+            path = os.path.join(self.directory, subdir, gmail_id)
+            if os.path.exists(path):
+                self._paths[gmail_id] = path
+                return True
+        return False
+
+    def ids(self):
+        """ Return an iterable of the Gmail IDs of all archived messages """
+        return self._paths.keys()
+
+    def add(self, gmail_id, source, labels=None, info=None):
+        """ Archive the raw message `source` in new/`gmail_id` """
+        self._write(gmail_id, [source])
+
+    def add_stream(self, gmail_id, source_fh, labels=None, info=None):
+        """ Copy the raw message read from `source_fh` to new/`gmail_id` in
+            chunks
+        """
+        self._write(gmail_id,
+                    iter(lambda: source_fh.read(COPY_BUFSIZE), ""))
+
+    def read(self, gmail_id):
+        if gmail_id not in self or not os.path.exists(self._paths[gmail_id]):
+            # a mail client may have moved or flagged it since the listing
+            self._list_messages()
+        msg_fh = open(self._paths[gmail_id], "rb")
+        try:
+            return msg_fh.read()
+        finally:
+            msg_fh.close()
+
+    def _write(self, gmail_id, chunks):
+        """ Write the message consisting of `chunks` to new/`gmail_id` """
+        tmpfile = os.path.join(self.directory, 'tmp', "%s.%s.%s"
+                               % (gmail_id, os.getpid(), thread.get_ident()))
+        path = os.path.join(self.directory, 'new', gmail_id)
+        msg_fh = open(tmpfile, "wb")
+        try:
+            msg_fh.write("X-GmailID: %s\n" % gmail_id)
+            for chunk in chunks:
+                msg_fh.write(chunk)
+            msg_fh.flush()
+            os.fsync(msg_fh.fileno())
+        except:
+            msg_fh.close()
+            os.remove(tmpfile)
+            raise
+        msg_fh.close()
+        os.rename(tmpfile, path)
+        self._paths[gmail_id] = path
+
+    def remove(self, stale_ids):
+        """ Delete the files of the messages `stale_ids` and return the
+            number of bytes reclaimed
+        """
+        reclaimed = 0
+        listed = False
+        for gmail_id in stale_ids:
+            path = self._paths.pop(gmail_id, None)
+            if (path is None or not os.path.exists(path)) and not listed:
+                # a mail client may have moved it to cur/ since the listing
+                self._list_messages()
+                listed = True
+                path = self._paths.pop(gmail_id, None)
+            if path is None:
+                continue
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue # already deleted by someone else
+            reclaimed += size
+        return reclaimed
+
+    def close(self):
+        """ Nothing to do: every message is on disk as soon as it is added """
+        pass
+
+
+class SqliteStore(ArchiveStore):
+    """ Archive in an SQLite database, with one row per message.
+
+        Every row is keyed by the Gmail ID and holds the raw message together
+        with its thread ID, date, sender, subject and size. The labels of
+        every message are kept in a separate table that is indexed by label,
+        so that archived-message checks, per-label listings, thread
+        reconstruction and pruning are all indexed queries.
+
+        Every message is stored as a single value, so `add_stream` reads it
+        completely first.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            gmail_id TEXT PRIMARY KEY,
+            thread_id TEXT,
+            date TEXT,
+            sender TEXT,
+            subject TEXT,
+            size INTEGER,
+            source BLOB);
+        CREATE INDEX IF NOT EXISTS messages_thread_id
+            ON messages (thread_id);
+        CREATE TABLE IF NOT EXISTS labels (
+            gmail_id TEXT,
+            label TEXT,
+            PRIMARY KEY (gmail_id, label));
+        CREATE INDEX IF NOT EXISTS labels_label ON labels (label);
+    """
+
+    # Number of added messages after which the transaction is committed
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, dbfile, verbose=False):
+        self.dbfile = dbfile
+        self.verbose = verbose
+        self.db = None
+        self._uncommitted = 0
+
+    def open(self):
+        """ Open the database, creating the tables if necessary """
+        self.db = sqlite3.connect(self.dbfile)
+        self.db.text_factory = str
+        self.db.executescript(self.SCHEMA)
+
+    def __contains__(self, gmail_id):
+        return self.db.execute("SELECT 1 FROM messages WHERE gmail_id = ?",
+                               (gmail_id,)).fetchone() is not None
+
+    def ids(self):
+        """ Return an iterable of the Gmail IDs of all archived messages """
+        return [row[0] for row
+                in self.db.execute("SELECT gmail_id FROM messages")]
+
+    def _set_labels(self, gmail_id, labels):
+        self.db.executemany(
+            "INSERT OR IGNORE INTO labels (gmail_id, label) VALUES (?, ?)",
+            [(gmail_id, label) for label in labels])
+
+    def add(self, gmail_id, source, labels=None, info=None):
+        """ Store the raw message `source` and its metadata under
+            `gmail_id`
+        """
+        if info is None:
+            info = {}
+        self.db.execute(
+            "INSERT OR REPLACE INTO messages (gmail_id, thread_id, date, "
+            "sender, subject, size, source) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (gmail_id, info.get('thread_id'), info.get('date'),
+             info.get('sender'), info.get('subject'), len(source),
+             sqlite3.Binary(source)))
+        if labels:
+            self._set_labels(gmail_id, labels)
+        self._uncommitted += 1
+        if self._uncommitted >= self.COMMIT_INTERVAL:
+            self.db.commit()
+            self._uncommitted = 0
+
+    def read(self, gmail_id):
+        row = self.db.execute("SELECT source FROM messages WHERE gmail_id = ?",
+                              (gmail_id,)).fetchone()
+        if row is None:
+            raise KeyError(gmail_id)
+        return str(row[0])
+
+    def record_thread(self, thread_id, labels, gmail_ids):
+        """ Add the thread's `labels` to the labels of the archived messages
+            `gmail_ids`. Labels stored with the messages (e.g. those of the
+            searches that found them) are kept.
+        """
+        for gmail_id in gmail_ids:
+            if gmail_id in self:
+                self._set_labels(gmail_id, labels or [])
+
+    def remove(self, stale_ids):
+        """ Delete the rows of the messages `stale_ids` and return the
+            total size of the removed messages
+        """
+        stale_ids = [(gmail_id,) for gmail_id in stale_ids]
+        reclaimed = 0
+        for (gmail_id,) in stale_ids:
+            row = self.db.execute("SELECT size FROM messages "
+                                  "WHERE gmail_id = ?", (gmail_id,)).fetchone()
+            if row is not None:
+                reclaimed += row[0]
+        self.db.executemany("DELETE FROM messages WHERE gmail_id = ?",
+                            stale_ids)
+        self.db.executemany("DELETE FROM labels WHERE gmail_id = ?",
+                            stale_ids)
+        return reclaimed
+
+    def close(self):
+        """ Commit all changes and close the database """
+        self.db.commit()
+        self.db.close()
+
+
+class BlobArchiveStore(ArchiveStore):
+    """ Wrapper around another ArchiveStore that moves large MIME parts of
+        every added message into a content-addressed BlobStore, leaving a
+        stub in the archived message (see archive_blobs).
+
+        Blobs may be shared between messages, so they are not deleted when
+        messages are removed from the archive.
+    """
+
+    def __init__(self, store, blobs, threshold, verbose=False):
+        self.store = store
+        self.blobs = blobs
+        self.threshold = threshold
+        self.verbose = verbose
+
+    def open(self):
+        self.store.open()
+
+    def __contains__(self, gmail_id):
+        return gmail_id in self.store
+
+    def ids(self):
+        return self.store.ids()
+
+    def searched_ids(self, search_labels):
+        return self.store.searched_ids(search_labels)
+
+    def add(self, gmail_id, source, labels=None, info=None):
+        """ Archive `source` with all MIME parts of at least `threshold`
+            bytes replaced by blob stubs. Messages that are known to have no
+            attachments are archived unchanged.
+        """
+        if info is None or info.get('attachments', 1):
+            source = self.blobs.externalize(source, self.threshold)
+        self.store.add(gmail_id, source, labels, info)
+
+    def add_stream(self, gmail_id, source_fh, labels=None, info=None):
+        """ Stream messages that are known to have no attachments to the
+            wrapped store. All others must be parsed as a whole.
+        """
+        if info is not None and not info.get('attachments', 1):
+            self.store.add_stream(gmail_id, source_fh, labels, info)
+        else:
+            self.add(gmail_id, source_fh.read(), labels, info)
+
+    def read(self, gmail_id):
+        """ Return the archived message with the content of its blobs put
+            back in place of the stubs
+        """
+        return self.blobs.reassemble(self.store.read(gmail_id))
+
+    def record_thread(self, thread_id, labels, gmail_ids):
+        self.store.record_thread(thread_id, labels, gmail_ids)
+
+    def remove(self, stale_ids):
+        return self.store.remove(stale_ids)
+
+    def close(self):
+        self.store.close()
+        if self.verbose:
+            print "Stored %d bytes in new blobs, %d bytes deduplicated" \
+                  % (self.blobs.stored_bytes, self.blobs.deduplicated_bytes)
+
+
+def make_store(path, format='mbox', shard=None, scan_processes=None,
+               verbose=False, blob_threshold=None):
+    """ Return the (not yet opened) ArchiveStore for the archive at `path`.
+
+        `format` is one of FORMATS. For the 'mbox' format, `shard` may be one
+        of SHARD_BY to split the archive into several mbox files in the
+        directory `path`. If `blob_threshold` is given, MIME parts of at
+        least that many bytes are stored in the blob store `path`.blobs.
+    """
+    if format not in FORMATS:
+        raise ValueError("format must be one of %s" % (FORMATS,))
+    if format != 'mbox' and shard is not None:
+        raise ValueError("Only mbox archives can be sharded")
+    if format == 'maildir':
+        store = MaildirStore(path, verbose)
+    elif format == 'sqlite':
+        store = SqliteStore(path, verbose)
+    elif shard is None:
+        store = MboxStore(path, scan_processes, verbose)
+    else:
+        store = ShardedMboxStore(path, shard, scan_processes, verbose)
+    if blob_threshold:
+        blobs = BlobStore(path.rstrip(os.sep) + BLOBS_SUFFIX)
+        store = BlobArchiveStore(store, blobs, blob_threshold, verbose)
+    return store
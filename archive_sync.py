@@ -0,0 +1,181 @@
+""" Per-search high-water marks and thread index for incremental archiving """
+
+############################################################################
+#    Copyright (C) 2008 by Michael Goerz                                   #
+#    http://www.physik.fu-berlin.de/~goerz                                 #
+#                                                                          #
+#    This program is free software; you can redistribute it and/or modify  #
+#    it under the terms of the GNU General Public License as published by  #
+#    the Free Software Foundation; either version 3 of the License, or     #
+#    (at your option) any later version.                                   #
+#                                                                          #
+#    This program is distributed in the hope that it will be useful,       #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#    GNU General Public License for more details.                          #
+#                                                                          #
+#    You should have received a copy of the GNU General Public License     #
+#    along with this program; if not, write to the                         #
+#    Free Software Foundation, Inc.,                                       #
+#    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
+############################################################################
+
+import os
+import urllib
+
+SYNC_SUFFIX = ".sync"
+SYNC_MAGIC = "# gmail_archive sync"
+THREAD_INDEX_SUFFIX = ".threadindex"
+THREAD_INDEX_MAGIC = "# gmail_archive thread index"
+
+# The high-water mark holds this many times more threads than the run of
+# unchanged threads needed to stop a listing, so that some of them may get
+# new messages (and move to the top) without forcing a full listing.
+MARK_FACTOR = 4
+
+
+def search_key(label=None, query=None):
+    """ Return the key under which the high-water mark of a label/folder or
+        query is stored
+    """
+    if label is not None:
+        return "label:%s" % label
+    return "query:%s" % query
+
+
+class SyncState(object):
+    """ High-water marks of previous runs, stored in a file next to the
+        archive (ARCHIVE.sync by default).
+
+        For every label, folder or query, the high-water mark is the list of
+        the most recent threads (thread id, number of messages) that were
+        completely archived in the last successful run. A new listing of the
+        same search can stop as soon as it reaches a run of these threads
+        whose message count hasn't changed.
+    """
+
+    def __init__(self, archive_path, syncfile=None):
+        if syncfile is None:
+            syncfile = archive_path.rstrip(os.sep) + SYNC_SUFFIX
+        self.syncfile = syncfile
+        self.marks = {} # search key => [(thread_id, length), ...]
+
+    def load(self):
+        """ Read the high-water marks from disk; missing or unreadable files
+            are treated as empty
+        """
+        self.marks = {}
+        try:
+            sync_fh = open(self.syncfile)
+        except IOError:
+            return
+        try:
+            if sync_fh.readline().strip() != SYNC_MAGIC:
+                return
+            marks = {}
+            for line in sync_fh:
+                key, thread_id, length = line.split()
+                marks.setdefault(urllib.unquote(key), []).append(
+                    (thread_id, int(length)))
+        except ValueError:
+            return
+        finally:
+            sync_fh.close()
+        self.marks = marks
+
+    def save(self):
+        """ Write the high-water marks to disk, replacing the file
+            atomically
+        """
+        tmpfile = "%s.tmp%s" % (self.syncfile, os.getpid())
+        sync_fh = open(tmpfile, "w")
+        try:
+            sync_fh.write("%s\n" % SYNC_MAGIC)
+            for key, threads in self.marks.iteritems():
+                for thread_id, length in threads:
+                    sync_fh.write("%s %s %s\n"
+                                  % (urllib.quote(key, safe=''), thread_id,
+                                     length))
+        finally:
+            sync_fh.close()
+        os.rename(tmpfile, self.syncfile)
+
+    def known_threads(self, key):
+        """ Return dict mapping the thread ids of the high-water mark of
+            search `key` to their number of messages
+        """
+        return dict(self.marks.get(key, []))
+
+    def set_mark(self, key, threads):
+        """ Set the high-water mark of search `key` to the list of
+            (thread id, number of messages) of the most recent `threads`
+        """
+        self.marks[key] = list(threads)
+
+
+class ThreadIndex(object):
+    """ The gmail ids of the messages of every thread that was archived,
+        stored in a file next to the archive (ARCHIVE.threadindex by
+        default).
+
+        A listed thread with the same number of messages as recorded in the
+        index, all of which are still in the archive, has not changed since
+        it was archived, so its messages don't need to be retrieved.
+    """
+
+    def __init__(self, archive_path, indexfile=None):
+        if indexfile is None:
+            indexfile = archive_path.rstrip(os.sep) + THREAD_INDEX_SUFFIX
+        self.indexfile = indexfile
+        self.threads = {} # thread id => [gmail_id, ...]
+
+    def load(self):
+        """ Read the index from disk; missing or unreadable files are
+            treated as empty
+        """
+        self.threads = {}
+        try:
+            index_fh = open(self.indexfile)
+        except IOError:
+            return
+        try:
+            if index_fh.readline().strip() != THREAD_INDEX_MAGIC:
+                return
+            threads = {}
+            for line in index_fh:
+                fields = line.split()
+                threads[fields[0]] = fields[1:]
+        except IndexError:
+            return
+        finally:
+            index_fh.close()
+        self.threads = threads
+
+    def save(self):
+        """ Write the index to disk, replacing the file atomically """
+        tmpfile = "%s.tmp%s" % (self.indexfile, os.getpid())
+        index_fh = open(tmpfile, "w")
+        try:
+            index_fh.write("%s\n" % THREAD_INDEX_MAGIC)
+            for thread_id, gmail_ids in self.threads.iteritems():
+                index_fh.write("%s %s\n" % (thread_id, " ".join(gmail_ids)))
+        finally:
+            index_fh.close()
+        os.rename(tmpfile, self.indexfile)
+
+    def archived_ids(self, thread_id, length, archive):
+        """ Return the gmail ids of the thread `thread_id` if it was
+            archived with `length` messages and all of them are still in
+            `archive`, or None
+        """
+        gmail_ids = self.threads.get(thread_id)
+        if gmail_ids is None or len(gmail_ids) != length:
+            return None
+        for gmail_id in gmail_ids:
+            if gmail_id not in archive:
+                return None
+        return gmail_ids
+
+    def record(self, thread_id, gmail_ids):
+        """ Record the gmail ids of the messages of thread `thread_id` """
+        self.threads[thread_id] = list(gmail_ids)
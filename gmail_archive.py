@@ -21,52 +21,199 @@
 #    59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.             #
 ############################################################################
 
+import os
 import sys
 from optparse import OptionParser
 import libgmail
-from mailbox import mbox, mboxMessage
+from archive_storage import make_store, SHARD_BY, FORMATS
+from archive_sync import SyncState, ThreadIndex, search_key, MARK_FACTOR
+from archive_download import DownloadPool, ThreadPrefetcher
+from gmail_async import AsyncGmailAccount, EventLoop, runConcurrently
+from gmail_cache import ResponseCache, MetadataCache, DEFAULT_TTLS
+from lgconstants import U_THREADLIST_VIEW
 from cStringIO import StringIO
 from time import sleep
 
 
+def as_list(value):
+    """ Return `value` as a list: [] for None, [value] for a string """
+    if value is None:
+        return []
+    if isinstance(value, basestring):
+        return [value]
+    return list(value)
+
+
+def merge_listings(listings):
+    """ Merge the thread listings [(label, query, threads), ...] of several
+        searches into a list of threads without duplicates, in the order of
+        the listings. Return it, and a dict mapping the id of every thread
+        to the labels of the searches that listed it.
+    """
+    threads = []
+    search_labels = {}
+    for label, query, listing in listings:
+        for thread in listing:
+            labels = search_labels.get(thread.id)
+            if labels is None:
+                labels = search_labels[thread.id] = []
+                threads.append(thread)
+            if label is not None and label not in labels:
+                labels.append(label)
+    return threads, search_labels
+
+
 def main(mboxfile, threadsfile=None, labelsfile=None, username=None, 
          password=None, verbose=False, label=None, delete=False, 
          msg_delay=0, thread_delay=0, skip_thread_delay = 0, 
-         nodownload=False, query = None):
-    """ Archive Emails from Gmail to an mbox """
-
-    if username is None:
-        username = raw_input("Gmail account name: ")
-        
-    if password is None:
-        from getpass import getpass
-        password = getpass("Password: ")
+         nodownload=False, query = None, scan_processes=None, shard=None,
+         format='mbox', blob_threshold=None, incremental=0,
+         download_workers=0, async_requests=0, rate=None, burst=1,
+         stream=False, cache=None, cache_size=100, listing_ttl=None,
+         session=None, list_ahead=0, prefetch_threads=0,
+         prefetch_messages=None, thread_index=True):
+    """ Archive Emails from Gmail to an mbox
+    
+        `label` and `query` may also be lists of labels/folders and queries.
+        The listings of all these searches are merged, so that every thread
+        is retrieved and every message downloaded only once. A message is
+        archived with the labels of all searches that listed it, the first
+        of them first (with `shard='label'`, it is archived in the mbox file
+        of that label).
+        If `shard` is 'month' or 'label', `mboxfile` is a directory in which
+        the messages are archived to one mbox file per month or per label.
+        If `format` is 'maildir' or 'sqlite', `mboxfile` is a Maildir
+        directory or an SQLite database instead of an mbox file.
+        If `blob_threshold` is given, MIME parts of at least that many bytes
+        are stored only once in the directory `mboxfile`.blobs, and replaced
+        by a reference in the archived message.
+        If `incremental` is non-zero, the listing of threads stops after that
+        many consecutive threads that were already archived unchanged in
+        the previous run (unless `delete` is set, which needs the full
+        listing).
+        If `download_workers` is non-zero, messages are downloaded by that
+        many threads in parallel, and `msg_delay` is the minimum time
+        between the start of two downloads.
+        If `async_requests` is non-zero, threads are listed, retrieved and
+        downloaded on a single event loop with up to that many requests in
+        flight at once, and the delays are not used.
+        If `rate` is given, all requests to Gmail are limited to that many
+        per second (with bursts of up to `burst` requests). The rate is
+        lowered automatically when Gmail throttles or fails requests, and
+        recovers gradually afterwards.
+        If `stream` is given, every message is copied from the server to the
+        archive in chunks as it arrives, instead of being held in memory as
+        a whole.
+        If `cache` is given, thread lists and conversations are cached in
+        that directory (of at most `cache_size` MB), so that they are not
+        retrieved again by the next runs. Thread lists are cached for
+        `listing_ttl` seconds, conversations until they get new messages.
+        The label names and other account information are kept there as
+        well.
+        If `session` is given, the session saved in that file by the
+        previous run is used if it is still logged in (and belongs to
+        `username`, if given), instead of logging in again. The session is saved to the file after logging in and at
+        the end.
+        Archiving starts as soon as the first page of threads is listed.
+        The next pages are listed as they are needed, or with `list_ahead`,
+        up to that many pages ahead in the background.
+        If `prefetch_threads` is non-zero, the messages of up to that many
+        upcoming threads (with at most `prefetch_messages` messages in
+        total) are retrieved in the background while a thread is archived.
+        If `thread_index` is set, the messages of every archived thread are
+        recorded in the file `mboxfile`.threadindex, and the messages of a
+        thread are not retrieved again while its number of messages stays
+        the same.
+    """
 
-    if username.endswith("\n"): username = username[:-1]
-    if password.endswith("\n"): password = password[:-1]
+    def open_account(username="", password="", state=None):
+        ga = libgmail.GmailAccount(username, password, state=state)
+        if rate:
+            ga.rateLimiter = libgmail.RateLimiter(rate, burst)
+        if cache is not None:
+            ttls = DEFAULT_TTLS.copy()
+            if listing_ttl is not None:
+                ttls[U_THREADLIST_VIEW] = listing_ttl
+            ga.responseCache = ResponseCache(cache, cache_size * 1024 * 1024,
+                                             ttls)
+            ga.metadataCache = MetadataCache(os.path.join(cache, "metadata"))
+        if ga.connectionPool is not None:
+            # keep a connection for every download worker
+            ga.connectionPool.maxIdle = max(ga.connectionPool.maxIdle,
+                                            download_workers + 1)
+        return ga
 
-    ga = libgmail.GmailAccount(username, password)
+    def same_account(name, other_name):
+        """ Return whether the account names `name` and `other_name` (with
+            or without the Gmail domain) are the same
+        """
+        def normalize(name):
+            name = name.strip().lower()
+            for domain in ("@gmail.com", "@googlemail.com"):
+                if name.endswith(domain):
+                    name = name[:-len(domain)]
+            return name
+        return normalize(name) == normalize(other_name)
 
-    if verbose: print "\nPlease wait, logging in..."
+    ga = None
+    if session is not None and os.path.exists(session):
+        try:
+            state = libgmail.GmailSessionState(filename=session)
+        except Exception, data:
+            print "Ignoring unreadable session file %s: %s" % (session, data)
+        else:
+            saved_name = state.state[0]
+            if username is not None and not same_account(saved_name,
+                                                         username):
+                print "Ignoring session file %s of another account (%s)" \
+                      % (session, saved_name)
+            else:
+                if verbose: print "\nChecking saved session..."
+                ga = open_account(state=state)
+        if ga is not None:
+            if ga.checkSession():
+                if verbose: print "Reusing saved session of %s.\n" % ga.name
+            else:
+                if verbose: print "Saved session is no longer valid."
+                ga = None
 
     try:
-        ga.login()
+        if ga is None:
+            if username is None:
+                username = raw_input("Gmail account name: ")
+                
+            if password is None:
+                from getpass import getpass
+                password = getpass("Password: ")
+
+            if username.endswith("\n"): username = username[:-1]
+            if password.endswith("\n"): password = password[:-1]
+
+            ga = open_account(username, password)
+
+            if verbose: print "\nPlease wait, logging in..."
+
+            ga.login()
+            if verbose: print "Log in successful.\n"
     except libgmail.GmailLoginFailure:
         print "\nLogin failed. (Wrong username/password?)"
     else:
-        if verbose: print "Log in successful.\n"
+        if session is not None:
+            libgmail.GmailSessionState(ga).save(session)
 
-        searches = libgmail.STANDARD_FOLDERS + ga.getLabelNames()
+        # The label names are only needed to choose a label
+        if label is None and query is None:
+            choices = libgmail.STANDARD_FOLDERS + ga.getLabelNames()
 
         while label is None and query is None:
             print "Select folder or label to archive: (Ctrl-C to exit)"
 
-            for optionId, optionName in enumerate(searches):
+            for optionId, optionName in enumerate(choices):
                 print "  %d. %s" % (optionId, optionName)
-            print "  %d. %s" % (len(searches), "QUERY")
+            print "  %d. %s" % (len(choices), "QUERY")
 
             try:
-                label = searches[int(raw_input("Choice: "))]
+                label = choices[int(raw_input("Choice: "))]
             except ValueError:
                 print "Please select a folder or label by typing in the " \
                       "number in front of it."
@@ -79,84 +226,273 @@ def main(mboxfile, threadsfile=None, labelsfile=None, username=None,
                 return 1
             print
 
+        # (label, query) of every search
+        searches = [(search_label, None) for search_label in as_list(label)]
+        searches += [(None, search_query) for search_query in as_list(query)]
+
         if verbose: 
-            if label is not None:
-                print "Selected folder: %s" % label
-            else:
-                print "Selected query: %s" % query
+            for search_label, search_query in searches:
+                if search_label is not None:
+                    print "Selected folder: %s" % search_label
+                else:
+                    print "Selected query: %s" % search_query
+
+        sync_state = None
+        if incremental and not delete:
+            sync_state = SyncState(mboxfile)
+            sync_state.load()
 
-        if query is None:
-            if label in libgmail.STANDARD_FOLDERS:
-                result = ga.getMessagesByFolder(label, True)
+        aga = None
+        account = ga
+        if async_requests:
+            aga = AsyncGmailAccount(ga, EventLoop(async_requests))
+            account = aga
+        # Without the event loop, the threads of a single search are
+        # archived while the listing goes on
+        lazy_args = {}
+        if aga is None and len(searches) == 1:
+            lazy_args = {'lazy': True, 'prefetch': list_ahead}
+
+        def list_threads(search_label, search_query):
+            known_threads = None
+            if sync_state is not None:
+                known_threads = sync_state.known_threads(
+                    search_key(search_label, search_query))
+            if search_query is None:
+                if search_label in libgmail.STANDARD_FOLDERS:
+                    listing = account.getMessagesByFolder(search_label, True,
+                                                          known_threads,
+                                                          incremental,
+                                                          **lazy_args)
+                else:
+                    listing = account.getMessagesByLabel(search_label, True,
+                                                         known_threads,
+                                                         incremental,
+                                                         **lazy_args)
             else:
-                result = ga.getMessagesByLabel(label, True)
+                listing = account.getMessagesByQuery(search_query, True,
+                                                     known_threads,
+                                                     incremental,
+                                                     **lazy_args)
+            if aga is not None:
+                listing = aga.loop.runUntilComplete(listing)
+            return listing
+
+        listings = [(search_label, search_query,
+                     list_threads(search_label, search_query))
+                    for search_label, search_query in searches]
+        if len(listings) == 1:
+            result = listings[0][2]
+            search_labels = {}
         else:
-            result = ga.getMessagesByQuery(query, True)
+            result, search_labels = merge_listings(listings)
+            if verbose:
+                print "%d threads in %d searches" % (len(result),
+                                                      len(listings))
+        # labels of the searches of a thread missing from `search_labels`
+        default_labels = [search_label for search_label, search_query
+                          in searches if search_label is not None]
 
         if len(result):
-            archive_mbox = mbox(mboxfile)
-            archive_mbox.lock()
-            gmail_ids_in_mbox = {}
-            # get dict of gmail_ids already in mbox
-            for i, mbox_msg in enumerate(archive_mbox):
-                gmail_ids_in_mbox[mbox_msg['X-GmailID']] = i
+            archive = make_store(mboxfile, format, shard, scan_processes,
+                                 verbose, blob_threshold)
+            # get index of gmail_ids already archived
+            archive.open()
             labels_fh = StringIO()
             if labelsfile is not None:
                 labels_fh = open(labelsfile, "w")
             threads_fh = StringIO()
             if threadsfile is not None:
                 threads_fh = open(threadsfile, "w")
-            gmail_ids = []
+            gmail_ids = set()
+            queued_ids = set()
+            completed = False
+            marks = []
+            # The threads of this run are always recorded, to confirm that
+            # the threads of a high-water mark are archived
+            index = ThreadIndex(mboxfile)
+            if thread_index:
+                index.load()
+
+            def archived_ids(thread):
+                """ Return the ids of the messages of `thread` if it is
+                    archived unchanged, or None
+                """
+                if not thread_index or nodownload:
+                    return None
+                return index.archived_ids(thread.id, len(thread), archive)
+
+            pool = DownloadPool(download_workers, msg_delay, stream=stream)
+            prefetcher = ThreadPrefetcher(result, prefetch_threads,
+                                          prefetch_messages,
+                                          lambda thread:
+                                              archived_ids(thread) is None)
+
+            def write_downloaded(wait_all=False):
+                for gmail_msg, (msg_labels, info), source \
+                in pool.results(wait_all):
+                    if source is None:
+                        print "Couldn't retrieve message %s, skipped" \
+                              % gmail_msg.id
+                        continue
+                    if stream:
+                        try:
+                            archive.add_stream(gmail_msg.id.encode('ascii'),
+                                               source, msg_labels, info)
+                        finally:
+                            source.close()
+                    else:
+                        archive.add(gmail_msg.id.encode('ascii'), source, 
+                                    msg_labels, info)
+
+            def select_messages(thread, archived=None):
+                """ Return the messages of `thread` that need to be
+                    downloaded, as a list of (gmail_msg, (labels, info)),
+                    and the ids of all messages in the thread. If the ids
+                    of the `archived` messages of an unchanged thread are
+                    given, its messages are not retrieved.
+                """
+                if verbose: 
+                    print "\nThread ID: ", thread.id, " LEN ", len(thread)
+                labels_fh.write("%s: %s\n" % (thread.id, thread.getLabels()))
+                if archived is not None:
+                    if verbose: print "   all messages archived, skipped"
+                    gmail_ids.update(archived)
+                    return [], archived
+                gmail_ids_in_thread = []
+                downloads = []
+                for gmail_msg in thread:
+                    if verbose:
+                        print "  ", gmail_msg.id, gmail_msg.number
+                    gmail_ids_in_thread.append(str(gmail_msg.id))
+                    gmail_ids.add(str(gmail_msg.id))
+                    if nodownload:
+                        if verbose: print "    skipped (no download)"
+                        continue
+                    if str(gmail_msg.id) in archive \
+                    or str(gmail_msg.id) in queued_ids:
+                        if verbose: print "    skipped"
+                        continue # skip messages already in mbox
+                    msg_labels = list(thread.getLabels() or [])
+                    for search_label in reversed(
+                        search_labels.get(thread.id, default_labels)):
+                        if search_label in msg_labels:
+                            msg_labels.remove(search_label)
+                        msg_labels.insert(0, search_label)
+                    info = {'thread_id': thread.id,
+                            'date': gmail_msg.date,
+                            'sender': gmail_msg.sender,
+                            'subject': gmail_msg.subject,
+                            'attachments': len(gmail_msg.attachments)}
+                    queued_ids.add(str(gmail_msg.id))
+                    downloads.append((gmail_msg, (msg_labels, info)))
+                return downloads, gmail_ids_in_thread
+
+            def finish_thread(thread, gmail_ids_in_thread):
+                threads_fh.write("%s\n" % gmail_ids_in_thread)
+                archive.record_thread(thread.id, thread.getLabels(),
+                                      gmail_ids_in_thread)
+                index.record(thread.id, gmail_ids_in_thread)
+
+            def confirmed_mark(listing):
+                """ Return the high-water mark of `listing`: its most recent
+                    threads, up to the first one whose messages are not all
+                    in the archive (e.g. with `nodownload`, or if a download
+                    failed), so that a later run lists it again
+                """
+                mark = []
+                for thread in listing[:MARK_FACTOR*incremental]:
+                    if index.archived_ids(thread.id, len(thread),
+                                          archive) is None:
+                        break
+                    mark.append((thread.id, len(thread)))
+                return mark
+
+            def archive_thread_async(thread):
+                """ Coroutine that archives `thread` """
+                archived = archived_ids(thread)
+                if archived is None:
+                    yield aga.loadThread(thread)
+                downloads, gmail_ids_in_thread = select_messages(thread,
+                                                                 archived)
+                sources = yield [aga.getRawMessage(gmail_msg.id)
+                                 for gmail_msg, data in downloads]
+                for (gmail_msg, (msg_labels, info)), source \
+                in zip(downloads, sources):
+                    if source is None:
+                        print "Couldn't retrieve message %s, skipped" \
+                              % gmail_msg.id
+                        continue
+                    archive.add(gmail_msg.id.encode('ascii'), source, 
+                                msg_labels, info)
+                finish_thread(thread, gmail_ids_in_thread)
+
             try:
-                for i, thread in enumerate(result):
-                    if verbose: 
-                        print "\nThread ID: ", thread.id, " LEN ", \
-                              len(thread)
-                    labels_fh.write("%s: %s\n" 
-                                   % (thread.id, thread.getLabels()))
-                    gmail_ids_in_thread = []
-                    local_thread_delay = thread_delay
-                    for gmail_msg in thread:
-                        if verbose:
-                            print "  ", gmail_msg.id, gmail_msg.number
-                        gmail_ids_in_thread.append(str(gmail_msg.id))
-                        gmail_ids.append(str(gmail_msg.id))
-                        if nodownload:
-                            if verbose: print "    skipped (no download)"
-                            local_thread_delay = skip_thread_delay
-                            continue
-                        if gmail_ids_in_mbox.has_key(str(gmail_msg.id)):
-                            if verbose: print "    skipped"
-                            local_thread_delay = skip_thread_delay
-                            continue # skip messages already in mbox
-                        mbox_msg = mboxMessage(gmail_msg.source)
-                        mbox_msg.add_header("X-GmailID", 
-                                            gmail_msg.id.encode('ascii'))
-                        archive_mbox.add(mbox_msg)
-                        sleep(msg_delay)
-                    threads_fh.write("%s\n" % gmail_ids_in_thread)
-                    sleep(local_thread_delay)
+                if aga is not None:
+                    aga.loop.runUntilComplete(runConcurrently(aga.loop,
+                        (archive_thread_async(thread) for thread in result),
+                        async_requests))
+                else:
+                    for thread in prefetcher:
+                        archived = archived_ids(thread)
+                        downloads, gmail_ids_in_thread = \
+                            select_messages(thread, archived)
+                        for gmail_msg, data in downloads:
+                            pool.submit(gmail_msg, data)
+                            write_downloaded()
+                        finish_thread(thread, gmail_ids_in_thread)
+                        if archived is not None:
+                            continue # no request was made
+                        if len(downloads) < len(gmail_ids_in_thread):
+                            sleep(skip_thread_delay)
+                        else:
+                            sleep(thread_delay)
+                    write_downloaded(wait_all=True)
+                completed = True
                 if delete:
-                    for gmail_id in gmail_ids_in_mbox.keys():
-                        if gmail_id not in gmail_ids:
-                            mbox_id = gmail_ids_in_mbox[gmail_id]
-                            if verbose: 
-                                print "Delete id %s from mbox" % mbox_id
-                            archive_mbox.remove(mbox_id)
-
+                    stale_ids = set(archive.searched_ids(default_labels)) \
+                                - gmail_ids
+                    if verbose:
+                        for gmail_id in stale_ids:
+                            print "Delete id %s from archive" % gmail_id
+                    reclaimed = archive.remove(stale_ids)
+                    if verbose:
+                        print "Deleted %d messages, reclaimed %d bytes" \
+                              % (len(stale_ids), reclaimed)
+                if sync_state is not None:
+                    marks = [(search_key(search_label, search_query),
+                              confirmed_mark(listing))
+                             for search_label, search_query, listing
+                             in listings]
 
             except KeyboardInterrupt:
                 print "Keyboard Interrrupt"
             finally:
-                if verbose: print "Flushing and closing mbox file"
+                prefetcher.close()
+                pool.close()
+                if verbose: print "Transfer: %s" % ga.transferStats
+                if verbose and ga.responseCache is not None:
+                    print "Cache: %s" % ga.responseCache
+                if verbose: print "Flushing and closing archive"
                 threads_fh.close()
                 labels_fh.close()
-                archive_mbox.close()
+                archive.close()
+                if thread_index:
+                    index.save()
+                if sync_state is not None and completed:
+                    for key, mark in marks:
+                        sync_state.set_mark(key, mark)
+                    sync_state.save()
         else:
-            if label is not None:
-                print "No threads found in `%s`." % label
-            else:
-                print "No threads found in query `%s`." % query
+            for search_label, search_query in searches:
+                if search_label is not None:
+                    print "No threads found in `%s`." % search_label
+                else:
+                    print "No threads found in query `%s`." % search_query
+
+        if session is not None:
+            # with the cookies renewed during the run
+            libgmail.GmailSessionState(ga).save(session)
 
     if verbose: print "\n\nDone."
     
@@ -187,27 +523,30 @@ if __name__ == "__main__":
                           dest='labelsfile', 
                           help="File for storing label information. If not "
                           "specified, no label information will be stored.")
-    arg_parser.add_option('--label', action='store', type=str, 
+    arg_parser.add_option('--label', action='append', type=str, 
                           dest='label', 
                           help="Label or Folder to archive. If not specified, "
-                          "the program will ask for it")
-    arg_parser.add_option('--query', action='store', type=str, 
+                          "the program will ask for it. Can be given several "
+                          "times (also together with --query): the listings "
+                          "are then merged, and every message is downloaded "
+                          "once and archived with all its labels")
+    arg_parser.add_option('--query', action='append', type=str, 
                           dest='query', 
-                          help="Search to archive. This is an alternative to"
-                          "specifying a --label. Only the messages that match"
-                          "the search are archived. The --lable option takes "
-                          "preference over --query")
-    arg_parser.add_option('--msg_delay', action='store', type=int, 
+                          help="Search to archive. This is an alternative to "
+                          "specifying a --label. Only the messages that match "
+                          "the search are archived. Can be given several "
+                          "times")
+    arg_parser.add_option('--msg_delay', action='store', type=float, 
                           dest='msg_delay', default=0,
                           help="Number of seconds to wait between accessing "
                           "messages. This and the following delays may "
                           "hopefully prevent you being locked out of your "
                           "account")
-    arg_parser.add_option('--thread_delay', action='store', type=int, 
+    arg_parser.add_option('--thread_delay', action='store', type=float, 
                           dest='thread_delay', default=0,
                           help="Number of seconds to wait between accessing "
                           "threads.")
-    arg_parser.add_option('--skip_thread_delay', action='store', type=int, 
+    arg_parser.add_option('--skip_thread_delay', action='store', type=float, 
                           dest='skip_thread_delay', default=0,
                           help="Number of seconds to wait between accessing "
                           "threads that are not downloaded")
@@ -216,12 +555,121 @@ if __name__ == "__main__":
     arg_parser.add_option('--delete', action='store_true', 
                           dest='delete',
                           default=False, help="Delete archived emails that "
-                          "are no longer on the server")
+                          "are no longer on the server (with --shard label, "
+                          "only from the shards of the archived labels)")
     arg_parser.add_option('--nodownload', action='store_true', 
                           dest='nodownload',
                           default=False, help="Do not store any messages in "
                           "the mbox (behave like if the message was already "
                           "present there).")
+    arg_parser.add_option('--scan_processes', action='store', type=int, 
+                          dest='scan_processes', default=None,
+                          help="Number of processes used to scan a large "
+                          "MBOXFILE for archived messages when its index "
+                          "needs to be rebuilt. Defaults to the number of "
+                          "CPUs")
+    arg_parser.add_option('--shard', action='store', type='choice', 
+                          dest='shard', choices=SHARD_BY, default=None,
+                          help="Split the archive into one mbox file per "
+                          "month or per label (%s). MBOXFILE is then a "
+                          "directory holding the shards" % ", ".join(SHARD_BY))
+    arg_parser.add_option('--format', action='store', type='choice', 
+                          dest='format', choices=FORMATS, default='mbox',
+                          help="Storage format of the archive (%s). For "
+                          "maildir, MBOXFILE is a Maildir directory with one "
+                          "file per message, which allows concurrent "
+                          "writers. For sqlite, MBOXFILE is an SQLite "
+                          "database that also stores the thread, labels, "
+                          "date, sender and subject of every message. "
+                          "Default: mbox" % ", ".join(FORMATS))
+    arg_parser.add_option('--blob_threshold', action='store', type=int, 
+                          dest='blob_threshold', default=None,
+                          help="Store MIME parts (attachments) of at least "
+                          "this many bytes only once, in the directory "
+                          "MBOXFILE.blobs, and leave a reference to them in "
+                          "the archived message")
+    arg_parser.add_option('--incremental', action='store', type=int, 
+                          dest='incremental', default=0,
+                          help="Stop listing threads after this many "
+                          "consecutive threads that were already archived "
+                          "unchanged in the previous run. Ignored with "
+                          "--delete")
+    arg_parser.add_option('--download_workers', action='store', type=int, 
+                          dest='download_workers', default=0,
+                          help="Number of threads downloading messages in "
+                          "parallel. The messages are still written to the "
+                          "archive one at a time, in order. With this "
+                          "option, --msg_delay is the minimum time between "
+                          "the start of two downloads")
+    arg_parser.add_option('--rate', action='store', type=float, 
+                          dest='rate', default=None,
+                          help="Maximum number of requests per second "
+                          "(may be fractional), shared by the listing and "
+                          "all downloads. It is lowered automatically when "
+                          "Gmail throttles requests, and recovers gradually. "
+                          "This can replace the delay options")
+    arg_parser.add_option('--burst', action='store', type=int, 
+                          dest='burst', default=1,
+                          help="Number of requests that may be made at once "
+                          "under --rate. Default: 1")
+    arg_parser.add_option('--async_requests', action='store', type=int, 
+                          dest='async_requests', default=0,
+                          help="Number of requests that are multiplexed on "
+                          "a single event loop. Threads are then retrieved "
+                          "and their messages downloaded concurrently, "
+                          "without worker threads, and the delay options "
+                          "are ignored")
+    arg_parser.add_option('--stream', action='store_true', dest='stream',
+                          default=False, help="Copy every message from the "
+                          "server into the archive in chunks as it arrives, "
+                          "so that large messages are never held in memory "
+                          "as a whole (not for sqlite archives, or for "
+                          "messages with attachments with --blob_threshold)")
+    arg_parser.add_option('--cache', action='store', type=str, 
+                          dest='cache', default=None,
+                          help="Directory in which thread lists, "
+                          "conversations and label names are cached across "
+                          "runs. A cached "
+                          "conversation is used until the thread gets new "
+                          "messages")
+    arg_parser.add_option('--cache_size', action='store', type=int, 
+                          dest='cache_size', default=100,
+                          help="Maximum size of the --cache directory in "
+                          "MB. The least recently used pages are removed "
+                          "first. Default: 100")
+    arg_parser.add_option('--listing_ttl', action='store', type=int, 
+                          dest='listing_ttl', default=None,
+                          help="Number of seconds for which thread lists "
+                          "are taken from the --cache. Default: %d"
+                          % DEFAULT_TTLS[U_THREADLIST_VIEW])
+    arg_parser.add_option('--session', action='store', type=str, 
+                          dest='session', default=None,
+                          help="File in which the login session is saved. "
+                          "If the session saved by the previous run is "
+                          "still valid, it is used without logging in "
+                          "again. Keep this file private")
+    arg_parser.add_option('--list_ahead', action='store', type=int, 
+                          dest='list_ahead', default=0,
+                          help="Number of pages of threads that are listed "
+                          "ahead in the background while the threads of the "
+                          "current page are archived. Default: 0 (list the "
+                          "next page when it is needed)")
+    arg_parser.add_option('--prefetch_threads', action='store', type=int, 
+                          dest='prefetch_threads', default=0,
+                          help="Number of upcoming threads whose messages "
+                          "are retrieved in the background while the "
+                          "current thread is archived. Default: 0")
+    arg_parser.add_option('--prefetch_messages', action='store', type=int, 
+                          dest='prefetch_messages', default=None,
+                          help="Maximum number of messages of the threads "
+                          "retrieved ahead with --prefetch_threads, to "
+                          "bound the memory used. Default: no limit")
+    arg_parser.add_option('--no_thread_index', action='store_false', 
+                          dest='thread_index', default=True,
+                          help="Retrieve the messages of every listed "
+                          "thread, even if the thread index (MBOXFILE."
+                          "threadindex) shows that all of them are archived "
+                          "already")
     options, args = arg_parser.parse_args(sys.argv)
 
     try:
@@ -230,6 +678,20 @@ if __name__ == "__main__":
         print >> sys.stderr, "You did not provide enough parameters"
         arg_parser.print_help()
         sys.exit(1)
+    if options.shard is not None and options.format != 'mbox':
+        arg_parser.error("--shard can only be used with the mbox format")
+    if options.async_requests and options.download_workers:
+        arg_parser.error("--async_requests and --download_workers can't be "
+                         "used together")
+    if options.async_requests and options.stream:
+        arg_parser.error("--async_requests and --stream can't be used "
+                         "together")
+    if options.async_requests and options.list_ahead:
+        arg_parser.error("--async_requests and --list_ahead can't be used "
+                         "together")
+    if options.async_requests and options.prefetch_threads:
+        arg_parser.error("--async_requests and --prefetch_threads can't be "
+                         "used together")
     if options.authfile is not None:
         auth_fh = open(options.authfile)
         options.username = auth_fh.readline()
@@ -239,4 +701,11 @@ if __name__ == "__main__":
     main(mboxfile, options.threadsfile, options.labelsfile, options.username, 
          options.password, options.verbose, options.label, options.delete, 
          options.msg_delay, options.thread_delay, options.skip_thread_delay, 
-         options.nodownload, options.query)
+         options.nodownload, options.query, options.scan_processes,
+         options.shard, options.format, options.blob_threshold,
+         options.incremental, options.download_workers,
+         options.async_requests, options.rate, options.burst,
+         options.stream, options.cache, options.cache_size,
+         options.listing_ttl, options.session, options.list_ahead,
+         options.prefetch_threads, options.prefetch_messages,
+         options.thread_index)
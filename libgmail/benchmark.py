@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#
+# benchmark -- Benchmarks for libgmail
+#
+# License: GPL 2.0
+#
+# Usage:
+#
+#   python benchmark.py [NUMBER_OF_THREADS]
+#
+# The benchmarks run on synthetic pages in the format of Gmail, so no
+# account is needed. They compare the parsing speed and the memory used
+# by the threads of a listing with those of the former implementations.
+#
+
+import re
+import sys
+import types
+import timeit
+from cStringIO import StringIO
+
+import gmail_parser
+from lgconstants import *
+
+DEFAULT_THREADS = 2000
+THREADS_PER_PAGE = 100
+
+
+def execParsePage(pageContent):
+    """
+    The former `libgmail._parsePage`, which rewrote the embedded
+    Javascript into Python code and ran it. Used as the reference for the
+    results and speed of `gmail_parser.parsePage`.
+    """
+    lines = pageContent.splitlines()
+    data = '\n'.join([x for x in lines if x and x[0] in ['D', ')', ',', ']']])
+    data = re.sub(r'("(?:[^\\"]|\\.)*")', r'u\1', data)
+    data = re.sub(',{2,}', ',', data)
+
+    result = []
+    exec data in {'__builtins__': None}, {'D': lambda x: result.append(x)}
+
+    itemsDict = {}
+    for item in result:
+        name = item[0]
+        parsedValue = item[1:]
+        if itemsDict.has_key(name):
+            if len(parsedValue) and type(parsedValue[0]) is types.ListType:
+                for item in parsedValue:
+                    itemsDict[name].append(item)
+            else:
+                itemsDict[name].append(parsedValue)
+        else:
+            if len(parsedValue) and type(parsedValue[0]) is types.ListType:
+                itemsDict[name] = []
+                for item in parsedValue:
+                    itemsDict[name].append(item)
+            else:
+                itemsDict[name] = [parsedValue]
+    return itemsDict
+
+
+def threadListPage(numThreads, start = 0):
+    """
+    Return a thread list page with `numThreads` threads, numbered from
+    `start`.
+    """
+    lines = ['<html><head><script>',
+             'D(["v","44f09303f2d4f76f"]',
+             ');',
+             'D(["qu","1024 MB","7000 MB","14%","#006633"]',
+             ');',
+             'D(["ct",[["Friends",3],["Work \\"old\\"",0],["Lists",112]]]',
+             ');',
+             'D(["ts",%d,%d,%d,0,"Inbox","10a1b2c3",%d,,,]'
+             % (start, THREADS_PER_PAGE, numThreads + start, 3 * numThreads),
+             ');',
+             ]
+    for i in xrange(start, start + numThreads):
+        # The first thread is on the line of the record name
+        lines.append('%s["%x",%d,0,"<b>Jun %d</b>",'
+                     '"<span id=\'_user_user%d@example.com\'>User %d</span>'
+                     ', me (%d)","Subject number %d \\u00e9\\x26",'
+                     '"snippet of the message &hellip; line\\\\n %d",'
+                     '["^i","Friends","Lists"],"",,"%x",,0,"%d"]'
+                     % (i == start and 'D(["t",' or ',', 0x11a0000000000 + i, i % 2,
+                        i % 28 + 1, i, i, i % 7 + 1, i, i,
+                        0x11a0000000000 + i, i))
+    lines += [']', ');', 'D(["te"]);', '</script></head></html>']
+    return '\n'.join(lines)
+
+
+def benchmarkParse(numThreads = DEFAULT_THREADS, repeat = 3):
+    """
+    Check that `gmail_parser.parsePage` and `gmail_parser.parseStream`
+    return the same as `execParsePage` for a thread list page of
+    `numThreads` threads, and print the time they take to parse it.
+    """
+    page = threadListPage(numThreads)
+    def parseStream(page):
+        return gmail_parser.parseStream(StringIO(page))
+    if gmail_parser.parsePage(page) != execParsePage(page) \
+    or parseStream(page) != execParsePage(page):
+        raise AssertionError("parsePage and execParsePage disagree")
+    print "Parsing a thread list page with %d threads (%d bytes):" \
+          % (numThreads, len(page))
+    times = {}
+    for name, function in [('exec', execParsePage),
+                           ('gmail_parser', gmail_parser.parsePage),
+                           ('chunked', parseStream)]:
+        times[name] = min(timeit.repeat(lambda: function(page),
+                                        repeat = repeat, number = 1))
+        print "  %-14s %8.1f ms" % (name, times[name] * 1000)
+    print "  speedup        %8.1fx" % (times['exec'] / times['gmail_parser'])
+
+
+class DictThread(object):
+    """
+    The data of the former `libgmail.GmailThread`, which kept the thread
+    list entry and its fields in an instance dictionary. Used as the
+    reference for the memory used by `libgmail.GmailThread`.
+    """
+
+    def __init__(self, parent, threadsInfo):
+        self._parent = parent
+        self._account = self._parent._account
+        self.id = threadsInfo[T_THREADID]
+        self.subject = threadsInfo[T_SUBJECT_HTML]
+        self.snippet = threadsInfo[T_SNIPPET_HTML]
+        self._authors = threadsInfo[T_AUTHORS_HTML]
+        self.info = threadsInfo
+        self._length = 1
+        self._messages = []
+        self._labels = threadsInfo[T_CATEGORIES]
+
+
+def deepSize(roots, skip = ()):
+    """
+    Return the number of bytes used by the objects reachable from `roots`
+    through lists, tuples, dictionaries and instance attributes, counting
+    shared objects once. The objects in `skip` are not counted.
+    """
+    seen = set([id(obj) for obj in skip])
+    stack = list(roots)
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, (types.ListType, types.TupleType)):
+            stack.extend(obj)
+        elif isinstance(obj, types.DictType):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        else:
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+            for cls in type(obj).__mro__:
+                for name in cls.__dict__.get('__slots__', ()):
+                    if hasattr(obj, name):
+                        stack.append(getattr(obj, name))
+    return total
+
+
+def benchmarkMemory(numThreads = DEFAULT_THREADS):
+    """
+    Print the number of bytes per thread used by the threads of a thread
+    list page of `numThreads` threads, as `DictThread`s and as
+    `libgmail.GmailThread`s.
+    """
+    import libgmail
+
+    class Listing:
+        _account = None
+        _sharedValues = {}
+    listing = Listing()
+    print "Memory used by %d threads of a listing:" % numThreads
+    sizes = {}
+    for name, threadClass in [('dict', DictThread),
+                              ('slots', libgmail.GmailThread)]:
+        # The strings of every page are new, like those of a real listing
+        threads = [threadClass(listing, threadInfo) for threadInfo
+                   in gmail_parser.parsePage(threadListPage(numThreads))['t']]
+        sizes[name] = deepSize([threads], [listing]) / float(numThreads)
+        print "  %-14s %8d bytes per thread" % (name, sizes[name])
+    print "  saved          %8.0f%%" \
+          % (100 * (1 - sizes['slots'] / sizes['dict']))
+
+
+if __name__ == "__main__":
+    try:
+        numThreads = int(sys.argv[1])
+    except IndexError:
+        numThreads = DEFAULT_THREADS
+    benchmarkParse(numThreads)
+    print
+    benchmarkMemory(numThreads)
@@ -0,0 +1,756 @@
+#!/usr/bin/env python
+#
+# gmail_async -- Asynchronous Gmail access for libgmail
+#
+# License: GPL 2.0
+#
+# NOTE:
+#   Python 2 has no asyncio. The coroutines here are plain generators
+#   (PEP 342) that yield the `Future`s they wait for, and the event loop
+#   multiplexes non-blocking HTTP(S) connections with `asyncore`.
+#
+# Usage:
+#
+#   ga = libgmail.GmailAccount(name, pw)
+#   ga.login()
+#   aga = AsyncGmailAccount(ga)
+#   result = aga.loop.runUntilComplete(aga.getMessagesByLabel(label, True))
+#   sources = aga.loop.runUntilComplete(
+#       gather([aga.loop.spawn(aga.getRawMessage(msg.id))
+#               for thread in result for msg in thread]))
+#
+
+import sys
+import time
+import types
+import heapq
+import socket
+import asyncore
+import urllib
+import urllib2
+import urlparse
+import mimetools
+from errno import EWOULDBLOCK, EAGAIN
+from collections import deque
+from cStringIO import StringIO
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+import mechanize as ClientCookie
+from gmail_transport import body_decoder
+
+from lgconstants import *
+from libgmail import GmailError, GmailSearchResult, _parsePage, _buildURL, \
+     _buildSearchURL, _threadLength, _messagesFromItems
+
+DEFAULT_MAX_CONNECTIONS = 16
+MAX_REDIRECTS = 5
+RECV_BUFSIZE = 65536
+POLL_TIMEOUT = 1.0
+DEFAULT_TIMEOUT = 60
+USER_AGENT = 'Mozilla/5.0 (Compatible; libgmail-python)'
+
+
+class Return(Exception):
+    """
+    Raised by a coroutine to return `value` (generators can't `return` a
+    value in Python 2).
+    """
+    def __init__(self, value = None):
+        Exception.__init__(self)
+        self.value = value
+
+
+class Future(object):
+    """
+    Result of an operation that may not have finished yet.
+    """
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._excInfo = None
+        self._callbacks = []
+
+    def done(self):
+        """
+        """
+        return self._done
+
+    def result(self):
+        """
+        Return the result, or raise the exception of the operation.
+        """
+        if not self._done:
+            raise RuntimeError("Result is not available yet")
+        if self._excInfo is not None:
+            raise self._excInfo[0], self._excInfo[1], self._excInfo[2]
+        return self._result
+
+    def setResult(self, result):
+        """
+        """
+        self._result = result
+        self._finish()
+
+    def setException(self, excInfo):
+        """
+        `excInfo` -- As returned by `sys.exc_info()`.
+        """
+        self._excInfo = excInfo
+        self._finish()
+
+    def addDoneCallback(self, callback):
+        """
+        Call `callback(future)` once the future is done.
+        """
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _finish(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+def gather(futures):
+    """
+    Return a `Future` for the list of results of `futures`, which fails
+    with the first exception raised by one of them.
+    """
+    result = Future()
+    futures = list(futures)
+    remaining = [len(futures)]
+    def done(future):
+        if result.done():
+            return
+        if future._excInfo is not None:
+            result.setException(future._excInfo)
+            return
+        remaining[0] -= 1
+        if not remaining[0]:
+            result.setResult([future._result for future in futures])
+    if not futures:
+        result.setResult([])
+    for future in futures:
+        future.addDoneCallback(done)
+    return result
+
+
+def firstDone(futures):
+    """
+    Return a `Future` for the first of `futures` to be done.
+    """
+    result = Future()
+    def done(future):
+        if not result.done():
+            result.setResult(future)
+    for future in futures:
+        future.addDoneCallback(done)
+    return result
+
+
+class Task(Future):
+    """
+    Runs a generator-based coroutine on an `EventLoop`.
+
+    The coroutine yields a `Future`, another coroutine, or a list of them
+    to wait for; their result (or list of results) is sent back into the
+    generator, or their exception thrown into it. The coroutine returns a
+    value by raising `Return`.
+    """
+
+    def __init__(self, loop, coro):
+        Future.__init__(self)
+        self._loop = loop
+        self._coro = coro
+        loop.callSoon(self._step, None, None)
+
+    def _step(self, value, excInfo):
+        try:
+            if excInfo is None:
+                yielded = self._coro.send(value)
+            else:
+                yielded = self._coro.throw(*excInfo)
+        except StopIteration:
+            self.setResult(None)
+        except Return, ret:
+            self.setResult(ret.value)
+        except Exception:
+            self.setException(sys.exc_info())
+        else:
+            if type(yielded) is types.ListType:
+                yielded = gather([self._loop._asFuture(item)
+                                  for item in yielded])
+            else:
+                yielded = self._loop._asFuture(yielded)
+            yielded.addDoneCallback(self._wakeup)
+
+    def _wakeup(self, future):
+        # Resume from the loop rather than from the callback, so that long
+        # chains of finished futures don't nest.
+        self._loop.callSoon(self._step, future._result, future._excInfo)
+
+
+def runConcurrently(loop, coroutines, limit):
+    """
+    Coroutine that runs the coroutines from the iterable `coroutines`,
+    with at most `limit` of them running at a time. `coroutines` is only
+    consumed as coroutines finish, so it may be a (long) generator.
+    Fails with the first exception raised by one of the coroutines.
+    """
+    running = []
+    for coro in coroutines:
+        running.append(loop.spawn(coro))
+        while len(running) >= limit:
+            yield firstDone(running)
+            for task in [task for task in running if task.done()]:
+                running.remove(task)
+                task.result()
+    for task in running:
+        yield task
+
+
+class EventLoop(object):
+    """
+    Single threaded event loop that runs coroutines and multiplexes their
+    HTTP(S) requests over non-blocking sockets.
+
+    At most `maxConnections` requests are in flight at a time; further
+    requests wait for a connection to finish. A request that hasn't
+    completed within `timeout` seconds (from connecting to the end of the
+    response) is aborted with a `socket.timeout` error.
+    """
+
+    def __init__(self, maxConnections = DEFAULT_MAX_CONNECTIONS,
+                 timeout = DEFAULT_TIMEOUT):
+        self.maxConnections = maxConnections
+        self.timeout = timeout
+        self._map = {}          # asyncore socket map
+        self._ready = deque()   # (callback, args)
+        self._timers = []       # heap of (time, sequence, callback, args)
+        self._timerSeq = 0
+        self._cancelled = set() # sequence numbers of cancelled timers
+        self._waiting = deque() # (future, request) waiting for a connection
+        self._active = 0
+        self._addresses = {}    # host => IP address
+
+    def callSoon(self, callback, *args):
+        """
+        """
+        self._ready.append((callback, args))
+
+    def callLater(self, delay, callback, *args):
+        """
+        Call `callback(*args)` after `delay` seconds, and return a handle
+        for `cancelTimer`.
+        """
+        self._timerSeq += 1
+        heapq.heappush(self._timers,
+                       (time.time() + delay, self._timerSeq, callback, args))
+        return self._timerSeq
+
+    def cancelTimer(self, handle):
+        """
+        Don't make the call scheduled by `callLater` that returned `handle`.
+        """
+        self._cancelled.add(handle)
+
+    def sleep(self, delay):
+        """
+        Return a `Future` that is done after `delay` seconds.
+        """
+        future = Future()
+        self.callLater(delay, future.setResult, None)
+        return future
+
+    def spawn(self, coro):
+        """
+        Start running the coroutine `coro` and return its `Task`.
+        """
+        return Task(self, coro)
+
+    def _asFuture(self, obj):
+        if isinstance(obj, Future):
+            return obj
+        if type(obj) is types.GeneratorType:
+            return self.spawn(obj)
+        raise TypeError("Coroutine yielded %r instead of a Future" % (obj,))
+
+    def runUntilComplete(self, coroOrFuture):
+        """
+        Run the loop until the coroutine (or `Future`) `coroOrFuture` is
+        done, and return its result.
+        """
+        future = self._asFuture(coroOrFuture)
+        while not future.done():
+            self._runOnce()
+        return future.result()
+
+    def _runOnce(self):
+        while self._timers and self._timers[0][1] in self._cancelled:
+            self._cancelled.remove(heapq.heappop(self._timers)[1])
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - time.time())
+        elif self._map:
+            timeout = POLL_TIMEOUT
+        else:
+            raise RuntimeError("Event loop has nothing left to wait for")
+        if self._map:
+            asyncore.loop(timeout, map = self._map, count = 1)
+        elif timeout:
+            time.sleep(timeout)
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            when, seq, callback, args = heapq.heappop(self._timers)
+            if seq in self._cancelled:
+                self._cancelled.remove(seq)
+            else:
+                self._ready.append((callback, args))
+        ready, self._ready = self._ready, deque()
+        for callback, args in ready:
+            callback(*args)
+
+    def _resolve(self, host):
+        try:
+            return self._addresses[host]
+        except KeyError:
+            address = self._addresses[host] = socket.gethostbyname(host)
+            return address
+
+    def fetch(self, request):
+        """
+        Send `request` (a `urllib2.Request`) and return a `Future` for
+        its `HTTPResponse`. Redirects are not followed.
+        """
+        future = Future()
+        self._waiting.append((future, request))
+        self._startFetches()
+        return future
+
+    def _startFetches(self):
+        while self._waiting and self._active < self.maxConnections:
+            future, request = self._waiting.popleft()
+            self._active += 1
+            future.addDoneCallback(self._fetchDone)
+            try:
+                _HTTPFetch(self, future, request)
+            except Exception:
+                future.setException(sys.exc_info())
+
+    def _fetchDone(self, future):
+        self._active -= 1
+        self.callSoon(self._startFetches)
+
+
+class HTTPResponse(object):
+    """
+    Complete response to a request of an `EventLoop`, with the parts of
+    the `urllib2` response interface that cookie jars use.
+    """
+
+    def __init__(self, url, code, msg, headers, body):
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self.body = body
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def read(self):
+        return self.body
+
+
+def _parseResponse(url, data):
+    """
+    Parse the complete HTTP/1.0 response `data` to a request for `url`.
+    """
+    head, sep, body = data.partition("\r\n\r\n")
+    if not sep:
+        raise GmailError("Incomplete HTTP response from %s" % url)
+    statusLine, sep, headerText = head.partition("\r\n")
+    try:
+        version, code, msg = (statusLine.split(None, 2) + [""])[:3]
+        code = int(code)
+    except ValueError:
+        raise GmailError("Bad HTTP status line from %s: %r"
+                         % (url, statusLine))
+    headers = mimetools.Message(StringIO(headerText + "\r\n\r\n"))
+    length = headers.getheader('Content-Length')
+    if length and length.isdigit() and len(body) < int(length):
+        raise GmailError("Incomplete HTTP response from %s" % url)
+    return HTTPResponse(url, code, msg, headers, body)
+
+
+def _wouldBlock(err):
+    """
+    Whether socket error `err` only means that the operation has to be
+    retried once the socket is ready.
+    """
+    if ssl is not None and isinstance(err, ssl.SSLError):
+        return err.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                               ssl.SSL_ERROR_WANT_WRITE)
+    return err.args[0] in (EWOULDBLOCK, EAGAIN)
+
+
+def _sslEOF(err):
+    """
+    Whether socket error `err` means that the server closed an SSL
+    connection without shutting down SSL first.
+    """
+    if ssl is None or not isinstance(err, ssl.SSLError):
+        return False
+    return err.args[0] == ssl.SSL_ERROR_EOF or "EOF" in str(err).upper()
+
+
+class _HTTPFetch(asyncore.dispatcher):
+    """
+    A single HTTP(S) request on its own non-blocking connection.
+
+    Requests are sent as HTTP/1.0 with `Connection: close`, so the response
+    is simply everything the server sends until it closes the connection.
+    """
+
+    def __init__(self, loop, future, request):
+        asyncore.dispatcher.__init__(self, map = loop._map)
+        self._future = future
+        self._url = request.get_full_url()
+        self._useSSL = request.get_type() == 'https'
+        if self._useSSL and ssl is None:
+            raise GmailError("No SSL support for %s" % self._url)
+        self._host, port = urllib.splitport(request.get_host())
+        if port is None:
+            port = [80, 443][self._useSSL]
+        self._out = self._requestData(request)
+        self._in = []
+        self._handshaking = False
+        self._wantWrite = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((loop._resolve(self._host), int(port)))
+        except:
+            self.close()
+            raise
+        if loop.timeout:
+            timer = loop.callLater(loop.timeout, self._timeOut, loop.timeout)
+            future.addDoneCallback(lambda future: loop.cancelTimer(timer))
+
+    def _timeOut(self, timeout):
+        self.close()
+        if self._future.done():
+            return
+        try:
+            raise socket.timeout("No response within %s seconds from %s"
+                                 % (timeout, self._url))
+        except socket.timeout:
+            self._future.setException(sys.exc_info())
+
+    def _requestData(self, request):
+        headers = dict(request.header_items())
+        headers.setdefault('Host', request.get_host())
+        headers['Connection'] = 'close'
+        data = request.get_data()
+        if data is not None:
+            headers.setdefault('Content-type',
+                               'application/x-www-form-urlencoded')
+            headers['Content-length'] = str(len(data))
+        lines = ["%s %s HTTP/1.0" % (request.get_method(),
+                                     request.get_selector())]
+        lines += ["%s: %s" % header for header in headers.items()]
+        return "\r\n".join(lines) + "\r\n\r\n" + (data or "")
+
+    def handle_connect(self):
+        if not self._useSSL:
+            return
+        self.del_channel()
+        if hasattr(ssl, 'create_default_context'):
+            sock = ssl.create_default_context().wrap_socket(
+                self.socket, server_hostname = self._host,
+                do_handshake_on_connect = False)
+        else:
+            sock = ssl.wrap_socket(self.socket,
+                                   do_handshake_on_connect = False)
+        self.set_socket(sock)
+        self._handshaking = True
+        self._handshake()
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, err:
+            if not _wouldBlock(err):
+                raise
+            self._wantWrite = err.args[0] == ssl.SSL_ERROR_WANT_WRITE
+        else:
+            self._handshaking = False
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        if not self.connected:
+            return True
+        if self._handshaking:
+            return self._wantWrite
+        return bool(self._out)
+
+    def handle_write(self):
+        if self._handshaking:
+            self._handshake()
+            return
+        try:
+            sent = self.socket.send(self._out)
+        except socket.error, err:
+            if not _wouldBlock(err):
+                raise
+            return
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        if self._handshaking:
+            self._handshake()
+            return
+        while True:
+            try:
+                data = self.socket.recv(RECV_BUFSIZE)
+            except socket.error, err:
+                if _sslEOF(err):
+                    # Closed without SSL close_notify; a truncated response
+                    # is caught by the Content-Length check.
+                    data = ""
+                elif _wouldBlock(err):
+                    return
+                else:
+                    raise
+            if not data:
+                self.handle_close()
+                return
+            self._in.append(data)
+            # Decrypted data buffered by SSL doesn't wake up select()
+            if not (self._useSSL and self.socket.pending()):
+                return
+
+    def handle_close(self):
+        self.close()
+        if self._future.done():
+            return
+        try:
+            response = _parseResponse(self._url, "".join(self._in))
+        except Exception:
+            self._future.setException(sys.exc_info())
+        else:
+            self._future.setResult(response)
+
+    def handle_error(self):
+        excInfo = sys.exc_info()
+        self.close()
+        if not self._future.done():
+            self._future.setException(excInfo)
+
+
+class AsyncGmailAccount(object):
+    """
+    Asynchronous counterpart of a logged in `GmailAccount`.
+
+    The methods are generator-based coroutines: run them with
+    `loop.runUntilComplete(...)`, spawn them with `loop.spawn(...)`, or
+    yield them from another coroutine. All requests share the cookies of
+    `account` and are multiplexed on `loop`, so many listings and downloads
+    can be in flight at once without a thread for each of them.
+
+    Note: Requests can't go through a proxy (`libgmail.PROXY_URL`).
+    """
+
+    def __init__(self, account, loop = None):
+        """
+        `account` -- Logged in `GmailAccount`.
+        """
+        self.account = account
+        if loop is None:
+            loop = EventLoop()
+        self.loop = loop
+
+
+    def _retrievePage(self, urlOrRequest):
+        """
+        Coroutine version of `GmailAccount._retrievePage`.
+        """
+        if not isinstance(urlOrRequest, urllib2.Request):
+            req = ClientCookie.Request(urlOrRequest)
+        else:
+            req = urlOrRequest
+
+        limiter = self.account.rateLimiter
+        for redirect in xrange(MAX_REDIRECTS + 1):
+            req.add_header('User-Agent', USER_AGENT)
+            req.add_header('Accept-encoding', 'gzip, deflate')
+            self.account._cookieJar.add_cookie_header(req)
+            if limiter is not None:
+                delay = limiter.reserve()
+                if delay > 0:
+                    yield self.loop.sleep(delay)
+            try:
+                resp = yield self.loop.fetch(req)
+            except IOError:
+                if limiter is not None:
+                    limiter.record(None)
+                raise
+            if limiter is not None:
+                limiter.record(resp.code)
+            self.account._cookieJar.extract_cookies(resp, req)
+            location = resp.info().getheader('Location')
+            if resp.code in (301, 302, 303, 307) and location:
+                req = ClientCookie.Request(
+                    urlparse.urljoin(req.get_full_url(), location))
+                continue
+            if resp.code >= 400:
+                # Like the urllib2.HTTPError in `GmailAccount._retrievePage`
+                print "HTTP Error %d: %s" % (resp.code, resp.msg)
+                raise Return(None)
+            raise Return(self._decodeBody(resp))
+        raise GmailError("Too many redirects for %s" % req.get_full_url())
+
+
+    def _decodeBody(self, resp):
+        """
+        Return the body of `resp`, decompressed if needed.
+        """
+        body = resp.read()
+        encoding = (resp.info().getheader('Content-Encoding') or '').lower()
+        decoder = body_decoder(encoding, body)
+        if decoder is None:
+            decoded = body
+        else:
+            decoded = decoder.decompress(body) + decoder.flush()
+        self.account.transferStats.add(len(body), len(decoded))
+        return decoded
+
+
+    def _parsePage(self, urlOrRequest, cacheVersion = None):
+        """
+        Coroutine version of `GmailAccount._parsePage`.
+        """
+        cache = self.account.responseCache
+        if cache is None or not isinstance(urlOrRequest, basestring) \
+        or not cache.cacheable(urlOrRequest):
+            cache = None
+        cached = cache and cache.get(self.account.name, urlOrRequest,
+                                     cacheVersion)
+        if cached is not None:
+            try:
+                page = cached.read()
+            finally:
+                cached.close()
+        else:
+            page = yield self._retrievePage(urlOrRequest)
+            if page is None:
+                raise GmailError("Failed to retrieve page from gmail.")
+        items = _parsePage(page)
+        # Pages without data (e.g. errors) are not cached
+        if cache is not None and cached is None and items:
+            cache.put(self.account.name, urlOrRequest, cacheVersion, page)
+        self.account._cacheItems(items)
+        raise Return(items)
+
+
+    def _parseThreadSearch(self, searchType, allPages = False,
+                           knownThreads = None, knownRun = 0, **kwargs):
+        """
+        Coroutine version of `GmailAccount._parseThreadSearch`.
+
+        The pages of a listing are retrieved one after the other, as each
+        page tells whether there is another one.
+        """
+        start = 0
+        known = 0
+        threadsInfo = []
+        while (start == 0) or (allPages and
+                               len(threadsInfo) < threadListSummary[TS_TOTAL]
+                               and not (knownRun and known >= knownRun)):
+            items = yield self._parsePage(
+                _buildSearchURL(searchType, start, **kwargs))
+            try:
+                threads = items[D_THREAD]
+            except KeyError:
+                break
+            for th in threads:
+                if not type(th[0]) is types.ListType:
+                    th = [th]
+                threadsInfo.append(th)
+                if knownThreads and knownRun:
+                    if knownThreads.get(th[0][T_THREADID]) == \
+                       _threadLength(th[0][T_AUTHORS_HTML]):
+                        known += 1
+                    else:
+                        known = 0
+            threadListSummary = items[D_THREADLIST_SUMMARY][0]
+            start += threadListSummary[TS_NUM]
+
+        raise Return(GmailSearchResult(self.account, (searchType, kwargs),
+                                       threadsInfo))
+
+
+    def getMessagesByFolder(self, folderName, allPages = False,
+                            knownThreads = None, knownRun = 0):
+        """
+        Coroutine version of `GmailAccount.getMessagesByFolder`.
+        """
+        return self._parseThreadSearch(folderName, allPages = allPages,
+                                       knownThreads = knownThreads,
+                                       knownRun = knownRun)
+
+
+    def getMessagesByQuery(self, query, allPages = False,
+                           knownThreads = None, knownRun = 0):
+        """
+        Coroutine version of `GmailAccount.getMessagesByQuery`.
+        """
+        return self._parseThreadSearch(U_QUERY_SEARCH, q = query,
+                                       allPages = allPages,
+                                       knownThreads = knownThreads,
+                                       knownRun = knownRun)
+
+
+    def getMessagesByLabel(self, label, allPages = False,
+                           knownThreads = None, knownRun = 0):
+        """
+        Coroutine version of `GmailAccount.getMessagesByLabel`.
+        """
+        return self._parseThreadSearch(U_CATEGORY_SEARCH,
+                                       cat = label, allPages = allPages,
+                                       knownThreads = knownThreads,
+                                       knownRun = knownRun)
+
+
+    def getRawMessage(self, msgId):
+        """
+        Coroutine version of `GmailAccount.getRawMessage`.
+        """
+        return self._retrievePage(
+            _buildURL(view = U_ORIGINAL_MESSAGE_VIEW, th = msgId))
+
+
+    def loadThread(self, thread):
+        """
+        Coroutine that retrieves the conversation of `thread` (a
+        `GmailThread`), so that iterating over the thread doesn't block,
+        and returns its messages.
+        """
+        items = yield self._parsePage(
+            _buildSearchURL(U_QUERY_SEARCH, view = U_CONVERSATION_VIEW,
+                            th = thread.id, q = "in:anywhere"),
+            cacheVersion = len(thread))
+        thread._messages = _messagesFromItems(thread, items)
+        raise Return(thread._messages)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+#
+# gmail_cache -- On-disk cache of Gmail pages for libgmail
+#
+# License: GPL 2.0
+#
+# Usage:
+#
+#   ga = libgmail.GmailAccount(name, pw)
+#   ga.responseCache = gmail_cache.ResponseCache("/var/tmp/libgmail-cache")
+#
+# Thread list and conversation pages are then read from the cache while
+# they are fresh. Pages are cached per account, so several accounts can
+# share a cache. A conversation page is cached together with the number of
+# messages in the thread, so it is retrieved again as soon as the thread
+# grows.
+#
+#   ga.metadataCache = gmail_cache.MetadataCache("/var/tmp/libgmail-meta")
+#
+# Label names and counts, quota and action token then survive the process,
+# so they need no request at the start of the next run.
+#
+
+import os
+import time
+import urllib
+import urlparse
+import thread
+import threading
+from hashlib import sha1
+from cPickle import load, dump
+
+from lgconstants import *
+
+CACHE_MAGIC = "# libgmail response cache"
+
+# Seconds for which the pages of a view are served from the cache. Pages
+# of other views are not cached.
+DEFAULT_TTLS = {U_THREADLIST_VIEW: 10 * 60,
+                U_CONVERSATION_VIEW: 30 * 24 * 60 * 60}
+
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+
+# Query parameters that don't change the content of a page
+IGNORED_PARAMS = ('zx',)
+
+# Keys of the account metadata, and the seconds for which it is valid
+META_LABEL_NAMES = "labelNames"
+META_LABEL_COUNTS = "labelCounts"
+META_QUOTA = "quota"
+META_ACTION_TOKEN = "actionToken"
+DEFAULT_META_TTLS = {META_LABEL_NAMES: 24 * 60 * 60,
+                     META_LABEL_COUNTS: 10 * 60,
+                     META_QUOTA: 24 * 60 * 60,
+                     META_ACTION_TOKEN: 60 * 60}
+
+
+def normalizeURL(url):
+    """
+    Return `url` with a lower case scheme and host, without ignored query
+    parameters, and with the query parameters sorted.
+    """
+    scheme, host, path, query, fragment = urlparse.urlsplit(url)
+    params = [(name, value) for name, value
+              in urlparse.parse_qsl(query, keep_blank_values = True)
+              if name not in IGNORED_PARAMS]
+    params.sort()
+    return urlparse.urlunsplit((scheme.lower(), host.lower(), path,
+                                urllib.urlencode(params), ''))
+
+
+def _view(url):
+    """
+    Return the `view` parameter of `url`, or None.
+    """
+    query = urlparse.urlsplit(url)[3]
+    return dict(urlparse.parse_qsl(query)).get(U_VIEW)
+
+
+class ResponseCache:
+    """
+    Size-bounded directory of cached page bodies, keyed by the account
+    name and the normalized URL of the page (and an optional version, e.g.
+    the number of messages of a conversation).
+
+    How long a page is fresh depends on its view (see `DEFAULT_TTLS`).
+    When the cache grows beyond `maxBytes`, the least recently used pages
+    are removed. `hits` and `misses` count the lookups of cacheable pages.
+
+    A cache can be shared by several threads.
+    """
+
+    def __init__(self, directory, maxBytes = DEFAULT_MAX_BYTES, ttls = None):
+        """
+        `ttls` -- Dictionary mapping views to the number of seconds their
+                  pages are fresh. Defaults to `DEFAULT_TTLS`.
+        """
+        self.directory = directory
+        self.maxBytes = maxBytes
+        if ttls is None:
+            ttls = DEFAULT_TTLS
+        self.ttls = ttls
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._sizes = {} # path => size of all cached pages
+        for subdir in self._listdir(directory):
+            subdir = os.path.join(directory, subdir)
+            for filename in self._listdir(subdir):
+                if '.tmp' not in filename:
+                    path = os.path.join(subdir, filename)
+                    self._sizes[path] = os.path.getsize(path)
+        self._totalBytes = sum(self._sizes.itervalues())
+
+
+    def _listdir(self, directory):
+        try:
+            return os.listdir(directory)
+        except OSError:
+            return []
+
+
+    def _key(self, account, url, version):
+        return "%s %s %s" % (account, normalizeURL(url), version)
+
+
+    def _path(self, key):
+        digest = sha1(key).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+
+    def cacheable(self, url):
+        """
+        Whether pages like `url` are cached.
+        """
+        return self.ttls.get(_view(url), 0) > 0
+
+
+    def get(self, account, url, version = None):
+        """
+        Return a file from which the cached body of the page `url` (with
+        `version`) of the account named `account` can be read, or None if
+        it is not cached or no longer fresh. The caller must close the
+        file.
+        """
+        key = self._key(account, url, version)
+        path = self._path(key)
+        try:
+            cacheFile = open(path, "rb")
+        except IOError:
+            cacheFile = None
+        else:
+            header = cacheFile.readline()[len(CACHE_MAGIC):].split(None, 1)
+            try:
+                fresh = header[1] == key + "\n" and \
+                        time.time() - float(header[0]) < \
+                        self.ttls.get(_view(url), 0)
+            except (ValueError, IndexError):
+                fresh = False
+            if fresh:
+                # Mark as recently used
+                os.utime(path, None)
+            else:
+                cacheFile.close()
+                cacheFile = None
+        self._lock.acquire()
+        try:
+            if cacheFile is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        finally:
+            self._lock.release()
+        return cacheFile
+
+
+    def record(self, account, url, version, pageFile):
+        """
+        Return a file-like wrapper of `pageFile` (the response for the
+        page `url` with `version` of `account`) that stores everything
+        read from it in the cache, once `commit` is called on it.
+        """
+        key = self._key(account, url, version)
+        return _RecordingFile(self, key, self._path(key), pageFile)
+
+
+    def put(self, account, url, version, body):
+        """
+        Store `body` as the page `url` with `version` of `account`.
+        """
+        self.record(account, url, version, None)._write(body).commit()
+
+
+    def _added(self, path, size):
+        """
+        Account for the cached page `path` of `size` bytes, and evict the
+        least recently used pages if the cache has grown too big.
+        """
+        self._lock.acquire()
+        try:
+            self._totalBytes += size - self._sizes.get(path, 0)
+            self._sizes[path] = size
+            if self._totalBytes <= self.maxBytes:
+                return
+            byAge = []
+            for cachedPath in self._sizes:
+                try:
+                    byAge.append((os.path.getmtime(cachedPath), cachedPath))
+                except OSError:
+                    byAge.append((0, cachedPath))
+            byAge.sort()
+            for mtime, cachedPath in byAge:
+                if self._totalBytes <= self.maxBytes:
+                    break
+                self._totalBytes -= self._sizes.pop(cachedPath)
+                try:
+                    os.remove(cachedPath)
+                except OSError:
+                    pass
+        finally:
+            self._lock.release()
+
+
+    def __str__(self):
+        return "%d cache hits, %d misses" % (self.hits, self.misses)
+
+
+class _RecordingFile:
+    """
+    File-like wrapper of a response body that copies the body to a
+    temporary file, which becomes a cache entry with `commit`.
+    """
+
+    def __init__(self, cache, key, path, pageFile):
+        self._cache = cache
+        self._path = path
+        self._pageFile = pageFile
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass # created by another thread
+        self._tmpfile = "%s.tmp%s.%s" % (path, os.getpid(),
+                                         thread.get_ident())
+        self._file = open(self._tmpfile, "wb")
+        self._file.write("%s %r %s\n" % (CACHE_MAGIC, time.time(), key))
+
+    def _write(self, data):
+        self._file.write(data)
+        return self
+
+    def read(self, amt = None):
+        if amt is None:
+            data = self._pageFile.read()
+        else:
+            data = self._pageFile.read(amt)
+        self._file.write(data)
+        return data
+
+    def commit(self):
+        """
+        Store the body read so far in the cache.
+        """
+        self._file.close()
+        size = os.path.getsize(self._tmpfile)
+        os.rename(self._tmpfile, self._path)
+        self._file = None
+        self._cache._added(self._path, size)
+
+    def close(self):
+        """
+        Close the response, and discard the body unless it was committed.
+        """
+        if self._pageFile is not None:
+            self._pageFile.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self._tmpfile)
+
+
+class MetadataCache:
+    """
+    Small persistent store of account metadata (see `DEFAULT_META_TTLS`),
+    kept in the pickle file `filename`.
+
+    Every value expires a fixed number of seconds after it was set; `get`
+    doesn't return expired values. Values are kept per account name, so
+    one file can be shared by several accounts. Every change is written
+    to the file at once (the file is replaced atomically). A file that
+    can't be read is ignored, and replaced on the first change.
+    """
+
+    def __init__(self, filename, ttls = None):
+        """
+        `ttls` -- Dictionary mapping metadata keys to the number of seconds
+                  their values are valid. Defaults to `DEFAULT_META_TTLS`.
+        """
+        self.filename = filename
+        if ttls is None:
+            ttls = DEFAULT_META_TTLS
+        self.ttls = ttls
+        self._lock = threading.Lock()
+        self._entries = {} # (account, key) => (expiry time, value)
+        try:
+            metaFile = open(filename, "rb")
+        except IOError:
+            return
+        try:
+            entries = load(metaFile)
+        except Exception:
+            # Truncated or corrupted, e.g. by a crash of an older version
+            return
+        finally:
+            metaFile.close()
+        if isinstance(entries, dict):
+            self._entries = entries
+
+
+    def get(self, account, key):
+        """
+        Return the value of `key` for `account`, or None if it is unknown
+        or expired.
+        """
+        try:
+            expires, value = self._entries[(account, key)]
+        except KeyError:
+            return None
+        if time.time() >= expires:
+            return None
+        return value
+
+
+    def set(self, account, key, value):
+        """
+        Set `key` for `account` to `value`, valid for the TTL of `key`.
+        Values that don't change are not written again before half of their
+        TTL has passed.
+        """
+        ttl = self.ttls.get(key, 0)
+        if ttl <= 0:
+            return
+        now = time.time()
+        self._lock.acquire()
+        try:
+            old = self._entries.get((account, key))
+            if old is not None and old[1] == value \
+            and old[0] - now > ttl / 2.0:
+                return
+            self._entries[(account, key)] = (now + ttl, value)
+            self._save()
+        finally:
+            self._lock.release()
+
+
+    def expire(self, account, key = None):
+        """
+        Forget `key` for `account`, or all metadata of `account`.
+        """
+        self._lock.acquire()
+        try:
+            expired = [entry for entry in self._entries
+                       if entry[0] == account and key in (None, entry[1])]
+            for entry in expired:
+                del self._entries[entry]
+            if expired:
+                self._save()
+        finally:
+            self._lock.release()
+
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmpfile = "%s.tmp%s" % (self.filename, os.getpid())
+        metaFile = open(tmpfile, "wb")
+        try:
+            dump(self._entries, metaFile, -1)
+        finally:
+            metaFile.close()
+        os.rename(tmpfile, self.filename)
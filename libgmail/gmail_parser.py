@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#
+# gmail_parser -- Parser for the data embedded in Gmail pages
+#
+# License: GPL 2.0
+#
+# Gmail pages carry their data as Javascript calls, one per record:
+#
+#   D(["ts",0,50,1234,0,"Inbox","...",1234]
+#   );
+#   D(["t",["1234abcd",1,0,"<b>Jun 2</b>", ...]
+#   ,["1234abce", ...]
+#   ]
+#   );
+#
+# Only lines starting with one of 'D', ')', ',' and ']' belong to the data.
+# The arguments of the calls are nested lists of strings and numbers, in
+# which list elements may be elided (as in `[1,,3]`).
+#
+
+import re
+import types
+
+# A single token: a string, a number, a name or any other character
+_TOKEN = re.compile(r'''
+      "[^"\\]*(?:\\.[^"\\]*)*"
+    | '[^'\\]*(?:\\.[^'\\]*)*'
+    | -?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?
+    | \w+
+    | \S
+    ''', re.VERBOSE | re.DOTALL)
+
+_NUMBER_STARTS = '-0123456789'
+
+# Number of bytes read at a time by `parseStream`
+CHUNK_SIZE = 65536
+
+DATA_LINE_STARTS = 'D),]'
+
+
+class ParseError(ValueError):
+    """
+    Raised for page data that isn't a sequence of `D(...)` records.
+    """
+    pass
+
+
+def dataLines(pageContent):
+    """
+    Return the lines of `pageContent` that belong to the embedded data.
+    """
+    return [line for line in pageContent.splitlines()
+            if line and line[0] in DATA_LINE_STARTS]
+
+
+def addItem(itemsDict, item):
+    """
+    Add the record `item` (the argument of a `D(...)` call) to
+    `itemsDict`, which maps record names to lists of values.
+    """
+    name = item[0]
+    parsedValue = item[1:]
+    # A name can be used more than once (e.g. mail items, mail body etc.);
+    # the values are collected into one list. A record whose first value
+    # is a list holds several values at once.
+    values = itemsDict.setdefault(name, [])
+    if len(parsedValue) and type(parsedValue[0]) is types.ListType:
+        values.extend(parsedValue)
+    else:
+        values.append(parsedValue)
+
+
+def _topLevelValue(value):
+    raise ParseError("Value %r outside of D(...)" % (value,))
+
+
+class PageParser(object):
+    """
+    Incremental parser for the `D(...)` records of a Gmail page.
+
+    The page is given to `feed` in chunks of any size, e.g. as they are
+    received, and ends with `close`. Every record is added to `items` (see
+    `addItem`) as soon as it is complete, and passed to `onRecord` if
+    that is given. Only the current line and the open record are kept.
+
+    Strings are decoded like Python unicode literals, which is how the
+    records were read before (by running them as Python code), numbers
+    become ints or floats, lists become lists and parenthesized values
+    tuples (except for a single value, which stays as it is). Elided list
+    elements are dropped.
+    """
+
+    def __init__(self, onRecord = None):
+        self.items = {}
+        self.onRecord = onRecord
+        self._partialLine = [] # pieces of the last, incomplete line
+        # Values of the open `[`, `(` and `D(`, innermost last
+        self._stack = []
+        # Opening tokens of the open `[`, `(` and `D(`
+        self._openings = []
+        self._call = False # after a top level `D`
+
+
+    def feed(self, data):
+        """
+        Parse the next chunk of the page.
+        """
+        end = max(data.rfind('\n'), data.rfind('\r')) + 1
+        if not end:
+            self._partialLine.append(data)
+            return
+        self._partialLine.append(data[:end])
+        lines = ''.join(self._partialLine)
+        self._partialLine = [data[end:]]
+        self.parse('\n'.join(dataLines(lines)))
+
+
+    def parse(self, data):
+        """
+        Parse the data lines `data`, adding the completed records to
+        `items`. A record may continue in the data of the next call.
+        """
+        # This loop runs for every token of a page: it dispatches on the
+        # first character of the token, keeps its state in local variables
+        # and appends values through the bound `append` of the innermost
+        # open list.
+        stack = self._stack
+        openings = self._openings
+        call = self._call
+        append = stack and stack[-1].append or _topLevelValue
+        try:
+            for token in _TOKEN.findall(data):
+                c = token[0]
+                if call and c != '(':
+                    raise ParseError("Expected '(' after 'D', got %r"
+                                     % token)
+                if c == '"':
+                    append(token[1:-1].decode('unicode_escape'))
+                elif c == ',':
+                    # Consecutive commas elide list elements
+                    if not stack:
+                        raise ParseError("Unexpected ','")
+                elif c == '[':
+                    values = []
+                    stack.append(values)
+                    openings.append('[')
+                    append = values.append
+                elif c == ']':
+                    if not openings or openings.pop() != '[':
+                        raise ParseError("Unexpected ']'")
+                    values = stack.pop()
+                    append = stack and stack[-1].append or _topLevelValue
+                    append(values)
+                elif c in _NUMBER_STARTS:
+                    try:
+                        number = int(token)
+                    except ValueError:
+                        try:
+                            number = float(token)
+                        except ValueError:
+                            raise ParseError("Malformed number %r" % token)
+                    append(number)
+                elif c == '(':
+                    values = []
+                    stack.append(values)
+                    openings.append(call and 'D(' or '(')
+                    append = values.append
+                    call = False
+                elif c == ')':
+                    if not openings or openings[-1] == '[':
+                        raise ParseError("Unexpected ')'")
+                    values = stack.pop()
+                    append = stack and stack[-1].append or _topLevelValue
+                    if openings.pop() == 'D(':
+                        if len(values) != 1:
+                            raise ParseError("D() takes 1 argument "
+                                             "(%d given)" % len(values))
+                        self._addRecord(values[0])
+                    elif len(values) == 1:
+                        append(values[0])
+                    else:
+                        append(tuple(values))
+                elif c == ';':
+                    if stack:
+                        raise ParseError("Unexpected ';'")
+                elif token == 'D' and not stack:
+                    call = True
+                elif c == "'":
+                    append(token[1:-1].decode('string_escape'))
+                else:
+                    raise ParseError("Unexpected %r" % token)
+        finally:
+            self._call = call
+
+
+    def _addRecord(self, record):
+        addItem(self.items, record)
+        if self.onRecord is not None:
+            self.onRecord(record)
+
+
+    def close(self):
+        """
+        Parse the rest of the page and check that the last record is
+        complete. Returns `items`.
+        """
+        lines = ''.join(self._partialLine)
+        self._partialLine = []
+        self.parse('\n'.join(dataLines(lines)))
+        if self._stack or self._call:
+            raise ParseError("Incomplete record at end of data")
+        return self.items
+
+
+def parsePage(pageContent):
+    """
+    Parse the supplied HTML page and return a dictionary mapping the
+    names of the records in its embedded data to lists of their values.
+
+    Raises `ParseError` if the data can't be parsed.
+    """
+    parser = PageParser()
+    parser.parse('\n'.join(dataLines(pageContent)))
+    return parser.close()
+
+
+def parseStream(pageFile, chunkSize = CHUNK_SIZE):
+    """
+    Like `parsePage`, but read the page from the file-like `pageFile`
+    `chunkSize` bytes at a time, parsing each chunk as it is read.
+    """
+    parser = PageParser()
+    while True:
+        data = pageFile.read(chunkSize)
+        if not data:
+            return parser.close()
+        parser.feed(data)
@@ -16,6 +16,9 @@ import urllib
 import httplib
 import socket
 import base64
+import urllib2
+import threading
+import zlib
 
 
 def split_proxy_URL(proxy):
@@ -141,3 +144,290 @@ class ConnectHTTPSHandler(ClientCookie.HTTPSHandler):
 		return ClientCookie.HTTPSHandler.do_open(self, ProxyHTTPSConnection.new_auth(self.proxy, self.proxy_user, self.proxy_passwd), req)
 
 
+# Persistent (keep-alive) connections, reused across requests
+
+class ConnectionPool:
+	"""Idle persistent HTTP(S) connections, at most `maxIdle` per host.
+
+	Connections are taken out of the pool for a request, and put back once
+	the response has been read completely. The pool can be shared by the
+	handlers of several threads."""
+
+	def __init__(self, maxIdle = 4):
+		self.maxIdle = maxIdle
+		self._idle = {}  # (connection class, host) => [connection, ...]
+		self._lock = threading.Lock()
+		self.connectionsOpened = 0
+		self.requestsSent = 0
+
+	def get(self, key):
+		self._lock.acquire()
+		try:
+			self.requestsSent += 1
+			connections = self._idle.get(key)
+			if connections:
+				return connections.pop()
+			self.connectionsOpened += 1
+			return None
+		finally:
+			self._lock.release()
+
+	def put(self, key, connection):
+		self._lock.acquire()
+		try:
+			connections = self._idle.setdefault(key, [])
+			if len(connections) < self.maxIdle:
+				connections.append(connection)
+				return
+		finally:
+			self._lock.release()
+		connection.close()
+
+	def close(self):
+		self._lock.acquire()
+		try:
+			idle, self._idle = self._idle, {}
+		finally:
+			self._lock.release()
+		for connections in idle.values():
+			for connection in connections:
+				connection.close()
+
+
+class PooledResponse:
+	"""File-like body of a response on a pooled connection. The connection
+	goes back to the pool as soon as the body has been read completely."""
+
+	def __init__(self, response, pool, key, connection):
+		self._response = response
+		self._pool = pool
+		self._key = key
+		self._connection = connection
+		self._buffer = ''
+		self._release()
+
+	def _release(self):
+		if self._connection is not None and self._response.isclosed():
+			if self._response.will_close:
+				self._connection.close()
+			else:
+				self._pool.put(self._key, self._connection)
+			self._connection = None
+
+	def read(self, amt = None):
+		if amt is None:
+			data = self._buffer + self._response.read()
+			self._buffer = ''
+		else:
+			data = self._buffer[:amt]
+			self._buffer = self._buffer[amt:]
+			if len(data) < amt:
+				data += self._response.read(amt - len(data))
+		self._release()
+		return data
+
+	def readline(self):
+		while '\n' not in self._buffer:
+			data = self._response.read(8192)
+			if not data:
+				break
+			self._buffer += data
+		self._release()
+		pos = self._buffer.find('\n') + 1 or len(self._buffer)
+		line, self._buffer = self._buffer[:pos], self._buffer[pos:]
+		return line
+
+	def close(self):
+		if self._connection is not None:
+			# Unread data is left on the connection, it can't be reused
+			self._connection.close()
+			self._connection = None
+		self._response.close()
+
+
+def keep_alive_open(pool, http_class, req, **connection_args):
+	"""Send `req` on a pooled connection of class `http_class`, opening a
+	new connection (with `connection_args`) if there is no idle one, and
+	return the response."""
+	host = req.get_host()
+	if not host:
+		raise urllib2.URLError('no host given')
+	headers = dict(req.unredirected_hdrs)
+	headers.update(req.headers)
+	headers = dict([(name.title(), value) for name, value in headers.items()])
+	headers['Connection'] = 'keep-alive'
+	timeout = getattr(req, 'timeout', None)
+	key = (http_class, host)
+	while True:
+		connection = pool.get(key)
+		reused = connection is not None
+		if not reused:
+			if isinstance(timeout, (int, float)):
+				connection_args['timeout'] = timeout
+			connection = http_class(host, **connection_args)
+		try:
+			connection.request(req.get_method(), req.get_selector(),
+							   req.get_data(), headers)
+			response = connection.getresponse()
+		except (socket.error, httplib.HTTPException), err:
+			connection.close()
+			if reused:
+				# The server closed the idle connection; try another one
+				continue
+			raise urllib2.URLError(err)
+		break
+	fp = PooledResponse(response, pool, key, connection)
+	result = urllib.addinfourl(fp, response.msg, req.get_full_url())
+	result.code = response.status
+	result.msg = response.reason
+	return result
+
+
+class KeepAliveHTTPHandler(ClientCookie.HTTPHandler):
+
+	def __init__(self, pool = None, debuglevel = 0):
+		if pool is None:
+			pool = ConnectionPool()
+		self.pool = pool
+		ClientCookie.HTTPHandler.__init__(self, debuglevel)
+
+	def do_open(self, http_class, req, **connection_args):
+		return keep_alive_open(self.pool, http_class, req, **connection_args)
+
+
+class KeepAliveHTTPSHandler(ClientCookie.HTTPSHandler):
+
+	def __init__(self, pool = None, debuglevel = 0):
+		if pool is None:
+			pool = ConnectionPool()
+		self.pool = pool
+		ClientCookie.HTTPSHandler.__init__(self, debuglevel)
+
+	def do_open(self, http_class, req, **connection_args):
+		return keep_alive_open(self.pool, http_class, req, **connection_args)
+
+
+# Compressed transfer
+
+class TransferStats:
+	"""Number of body bytes received on the wire, and after decoding"""
+
+	def __init__(self):
+		self.wireBytes = 0
+		self.decodedBytes = 0
+		self._lock = threading.Lock()
+
+	def add(self, wire, decoded):
+		self._lock.acquire()
+		try:
+			self.wireBytes += wire
+			self.decodedBytes += decoded
+		finally:
+			self._lock.release()
+
+	def __str__(self):
+		return "%d bytes received, %d bytes decoded" \
+			   % (self.wireBytes, self.decodedBytes)
+
+
+def body_decoder(encoding, data):
+	"""Return a zlib decompressor for a body with Content-Encoding
+	`encoding` that starts with `data`, or None if it isn't compressed."""
+	if encoding == 'gzip' or encoding == 'x-gzip':
+		return zlib.decompressobj(16 + zlib.MAX_WBITS)
+	if encoding == 'deflate':
+		# Should be zlib-wrapped, but some servers send a raw deflate stream
+		if len(data) >= 2 and ord(data[0]) & 0x0f == 8 \
+		and (ord(data[0]) * 256 + ord(data[1])) % 31 == 0:
+			return zlib.decompressobj()
+		return zlib.decompressobj(-zlib.MAX_WBITS)
+	return None
+
+
+class DecodingFile:
+	"""File-like body of a response that is decoded (if it has a gzip or
+	deflate Content-Encoding) as it is read, and counted in `stats`."""
+
+	CHUNK_SIZE = 65536
+
+	def __init__(self, fp, encoding, stats):
+		self._fp = fp
+		self._encoding = encoding
+		self._decoder = None
+		self._stats = stats
+		self._buffer = ''
+		self._started = False
+		self._eof = False
+
+	def _fill(self):
+		data = self._fp.read(self.CHUNK_SIZE)
+		if not self._started:
+			self._started = True
+			self._decoder = body_decoder(self._encoding, data)
+		if not data:
+			self._eof = True
+			decoded = self._decoder and self._decoder.flush() or ''
+		elif self._decoder is not None:
+			decoded = self._decoder.decompress(data)
+		else:
+			decoded = data
+		self._stats.add(len(data), len(decoded))
+		self._buffer += decoded
+
+	def read(self, amt = None):
+		if amt is None:
+			chunks = [self._buffer]
+			self._buffer = ''
+			while not self._eof:
+				self._fill()
+				chunks.append(self._buffer)
+				self._buffer = ''
+			return ''.join(chunks)
+		while len(self._buffer) < amt and not self._eof:
+			self._fill()
+		data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+		return data
+
+	def readline(self):
+		while '\n' not in self._buffer and not self._eof:
+			self._fill()
+		pos = self._buffer.find('\n') + 1 or len(self._buffer)
+		line, self._buffer = self._buffer[:pos], self._buffer[pos:]
+		return line
+
+	def close(self):
+		self._fp.close()
+
+
+class DecompressionProcessor(ClientCookie.BaseHandler):
+	"""Ask for gzip/deflate compressed responses, and decode them
+	transparently while they are read."""
+
+	# before HTTPErrorProcessor, so that error bodies are decoded as well
+	handler_order = 900
+
+	def __init__(self, stats = None):
+		if stats is None:
+			stats = TransferStats()
+		self.stats = stats
+
+	def http_request(self, req):
+		if not req.has_header('Accept-encoding'):
+			req.add_unredirected_header('Accept-encoding', 'gzip, deflate')
+		return req
+
+	def http_response(self, req, response):
+		headers = response.info()
+		encoding = (headers.getheader('Content-Encoding') or '').lower()
+		if encoding in ('gzip', 'x-gzip', 'deflate'):
+			# The body no longer has the encoding, nor its length
+			del headers['Content-Encoding']
+			del headers['Content-Length']
+		fp = DecodingFile(response, encoding, self.stats)
+		result = urllib.addinfourl(fp, headers, response.geturl())
+		result.code = response.code
+		result.msg = response.msg
+		return result
+
+	https_request = http_request
+	https_response = http_response
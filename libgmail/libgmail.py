@@ -28,13 +28,21 @@ LG_DEBUG=0
 from lgconstants import *
 
 import os,pprint
+import sys
 import re
 import urllib
 import urllib2
 import mimetypes
 import types
+import time
+import threading
+import Queue
 import mechanize as ClientCookie
+import gmail_transport
+import gmail_parser
+import gmail_cache
 from cPickle import load, dump
+from cStringIO import StringIO
 
 from email.MIMEBase import MIMEBase
 from email.MIMEText import MIMEText
@@ -96,48 +104,22 @@ def _parsePage(pageContent):
     the embedded Javascript.
     
     """
-    lines = pageContent.splitlines()
-    data = '\n'.join([x for x in lines if x and x[0] in ['D', ')', ',', ']']])
-    #data = data.replace(',,',',').replace(',,',',')
-    data = re.sub(r'("(?:[^\\"]|\\.)*")', r'u\1', data)
-    data = re.sub(',{2,}', ',', data)
-    
-    result = []
     try:
-        exec data in {'__builtins__': None}, {'D': lambda x: result.append(x)}
-    except SyntaxError,info:
+        return gmail_parser.parsePage(pageContent)
+    except gmail_parser.ParseError,info:
         print info
         raise GmailError, 'Failed to parse data returned from gmail.'
 
-    items = result 
-    itemsDict = {}
-    namesFoundTwice = []
-    for item in items:
-        name = item[0]
-        try:
-            parsedValue = item[1:]
-        except Exception:
-            parsedValue = ['']
-        if itemsDict.has_key(name):
-            # This handles the case where a name key is used more than
-            # once (e.g. mail items, mail body etc) and automatically
-            # places the values into list.
-            # TODO: Check this actually works properly, it's early... :-)
-            
-            if len(parsedValue) and type(parsedValue[0]) is types.ListType:
-                    for item in parsedValue:
-                        itemsDict[name].append(item)
-            else:
-                itemsDict[name].append(parsedValue)
-        else:
-            if len(parsedValue) and type(parsedValue[0]) is types.ListType:
-                    itemsDict[name] = []
-                    for item in parsedValue:
-                        itemsDict[name].append(item)
-            else:
-                itemsDict[name] = [parsedValue]
-
-    return itemsDict
+def _parseStream(pageFile):
+    """
+    Like `_parsePage`, but read the page from the file-like `pageFile`,
+    parsing it chunk by chunk as it arrives.
+    """
+    try:
+        return gmail_parser.parseStream(pageFile)
+    except gmail_parser.ParseError,info:
+        print info
+        raise GmailError, 'Failed to parse data returned from gmail.'
 
 def _splitBunches(infoItems):# Is this still needed ?? Stas
     """
@@ -153,6 +135,33 @@ def _splitBunches(infoItems):# Is this still needed ?? Stas
             result.append(group)
     return result
 
+def _threadLength(authors):
+    """
+    Extract the number of messages in a thread/conversation from the
+    authors string of a thread list entry (e.g. "me, John (3)").
+    """
+    try:
+        # TODO: Find out if this information can be found another way...
+        #       (Without another page request.)
+        return int(re.search("\((\d+?)\)\Z", authors).group(1))
+    except AttributeError,info:
+        # If there's no message count then the thread only has one message.
+        return 1
+
+def _intern(sharedValues, value):
+    """
+    Return the instance of `value` (a string or a tuple of strings) that
+    is kept in the dictionary `sharedValues`, so that recurring values like
+    label names and addresses are stored only once. Every listing has its
+    own dictionary (see `GmailSearchResult`), which goes away with it.
+    Byte strings are interned with the builtin `intern` instead.
+    """
+    if type(value) is str:
+        return intern(value)
+    if sharedValues is None:
+        return value
+    return sharedValues.setdefault(value, value)
+
 class SmartRedirectHandler(ClientCookie.HTTPRedirectHandler):
     def __init__(self, cookiejar):
         self.cookiejar = cookiejar
@@ -176,6 +185,19 @@ def _buildURL(**kwargs):
     return "%s%s" % (URL_GMAIL, urllib.urlencode(kwargs))
 
 
+def _buildSearchURL(searchType, start = 0, **kwargs):
+    """
+    Build the URL of a thread list (or, with a `view` argument, other)
+    search page.
+    """
+    params = {U_SEARCH: searchType,
+              U_START: start,
+              U_VIEW: U_THREADLIST_VIEW,
+              }
+    params.update(kwargs)
+    return _buildURL(**params)
+
+
 
 def _paramsToMime(params, filenames, files):
     """
@@ -229,6 +251,87 @@ def _paramsToMime(params, filenames, files):
     return mimeMsg
 
 
+class RateLimiter:
+    """
+    Token bucket that limits the rate of requests to `rate` requests per
+    second, allowing bursts of up to `burst` requests.
+
+    The rate adapts to the responses: it is halved whenever a request is
+    throttled (HTTP 429 or a server error, or no response at all), down
+    to `rate` / `MIN_RATE_DIVISOR`, and recovers gradually, by `rate` /
+    `RECOVERY_REQUESTS` with every successful request.
+
+    A single limiter can be shared by several threads.
+    """
+
+    BACKOFF = 0.5
+    MIN_RATE_DIVISOR = 100
+    RECOVERY_REQUESTS = 50
+
+    def __init__(self, rate, burst = 1):
+        """
+        `rate` -- Maximum number of requests per second (may be fractional).
+
+        `burst` -- Number of requests that may be made at once, after the
+                   limiter has been idle for a while.
+        """
+        if rate <= 0 or burst < 1:
+            raise ValueError("Rate limit must be positive")
+        self.maxRate = float(rate)
+        self.rate = self.maxRate
+        self.minRate = self.maxRate / self.MIN_RATE_DIVISOR
+        self.burst = burst
+        self.throttleCount = 0
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token for a request and return the number of seconds to wait
+        before making it.
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+        finally:
+            self._lock.release()
+
+    def acquire(self):
+        """
+        Wait until a request may be made.
+        """
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record(self, code):
+        """
+        Adapt the rate to the outcome of a request: `code` is the HTTP
+        status, or None if no response was received.
+        """
+        self._lock.acquire()
+        try:
+            if code is None or code == 429 or code >= 500:
+                self.throttleCount += 1
+                self.rate = max(self.minRate, self.rate * self.BACKOFF)
+                # No more bursts until the rate has recovered
+                self._tokens = min(self._tokens, 0)
+            elif code < 400:
+                self.rate = min(self.maxRate,
+                                self.rate + self.maxRate /
+                                self.RECOVERY_REQUESTS)
+        finally:
+            self._lock.release()
+
+
 class GmailLoginFailure(Exception):
     """
     Raised whenever the login process fails--could be wrong username/password,
@@ -261,35 +364,54 @@ class GmailAccount:
         else:
             URL_LOGIN = GMAIL_URL_LOGIN
             URL_GMAIL = GMAIL_URL_GMAIL
-        if name and pw:
+        self.connectionPool = None
+        # Body bytes received, and after decompression
+        self.transferStats = gmail_transport.TransferStats()
+        if state:
+            # Use `checkSession` to find out whether the state is stale.
+            # With a password, `login` can start a new session.
+            self.name, self._cookieJar = state.state
+            self._pw = pw
+        elif name and pw:
             self.name = name
             self._pw = pw
 
             self._cookieJar = ClientCookie.LWPCookieJar()
-            opener = ClientCookie.build_opener(ClientCookie.HTTPCookieProcessor(self._cookieJar))
-            ClientCookie.install_opener(opener)
-            
-            if PROXY_URL is not None:
-                import gmail_transport
-
-                self.opener = ClientCookie.build_opener(gmail_transport.ConnectHTTPHandler(proxy = PROXY_URL),
-                                  gmail_transport.ConnectHTTPSHandler(proxy = PROXY_URL),
-                                  SmartRedirectHandler(self._cookieJar))
-            else:
-                self.opener = ClientCookie.build_opener(
-                                ClientCookie.HTTPHandler(),
-                                ClientCookie.HTTPSHandler(),
-                                SmartRedirectHandler(self._cookieJar))
-        elif state:
-            # TODO: Check for stale state cookies?
-            self.name, self._cookieJar = state.state
         else:
             raise ValueError("GmailAccount must be instantiated with " \
                              "either GmailSessionState object or name " \
                              "and password.")
 
+        opener = ClientCookie.build_opener(ClientCookie.HTTPCookieProcessor(self._cookieJar))
+        ClientCookie.install_opener(opener)
+
+        if PROXY_URL is not None:
+            self.opener = ClientCookie.build_opener(gmail_transport.ConnectHTTPHandler(proxy = PROXY_URL),
+                              gmail_transport.ConnectHTTPSHandler(proxy = PROXY_URL),
+                              gmail_transport.DecompressionProcessor(self.transferStats),
+                              ClientCookie.HTTPCookieProcessor(self._cookieJar),
+                              SmartRedirectHandler(self._cookieJar))
+        else:
+            # Persistent connections, reused by all requests
+            self.connectionPool = gmail_transport.ConnectionPool()
+            self.opener = ClientCookie.build_opener(
+                gmail_transport.KeepAliveHTTPHandler(self.connectionPool),
+                gmail_transport.KeepAliveHTTPSHandler(self.connectionPool),
+                gmail_transport.DecompressionProcessor(self.transferStats),
+                ClientCookie.HTTPCookieProcessor(self._cookieJar),
+                SmartRedirectHandler(self._cookieJar))
+
         self._cachedQuotaInfo = None
         self._cachedLabelNames = None
+        self._cachedLabelCounts = None
+        self._cachedActionToken = None
+        # Set to a `RateLimiter` to limit the rate of all requests.
+        self.rateLimiter = None
+        # Set to a `gmail_cache.ResponseCache` to cache pages on disk.
+        self.responseCache = None
+        # Set to a `gmail_cache.MetadataCache` to keep label names, label
+        # counts, quota and action token across runs.
+        self.metadataCache = None
         
 
     def login(self):
@@ -314,6 +436,11 @@ class GmailAccount:
 
         req = ClientCookie.Request(URL_LOGIN, data=data, headers=headers)
         pageData = self._retrievePage(req)
+        # The new session comes with a new action token
+        self._cachedActionToken = None
+        if self.metadataCache is not None:
+            self.metadataCache.expire(self.name,
+                                      gmail_cache.META_ACTION_TOKEN)
         
         if not self.domain:
         # The GV cookie no longer comes in this page for
@@ -333,6 +460,29 @@ class GmailAccount:
             # just the cookie that is returned with it.
             pageData = self._retrievePage(redirectURL)
 
+    def checkSession(self):
+        """
+        Return whether the session is still logged in, by retrieving the
+        inbox (bypassing the `responseCache`). The account information on
+        the page is cached as usual.
+        """
+        resp = self._openPage(_buildSearchURL(U_INBOX_SEARCH))
+        if resp is None:
+            return False
+        try:
+            try:
+                items = gmail_parser.parseStream(resp)
+            except gmail_parser.ParseError:
+                # e.g. the login page
+                return False
+        finally:
+            resp.close()
+        if not items.has_key(D_THREADLIST_SUMMARY):
+            return False
+        self._cacheItems(items)
+        return True
+
+
     def getCookie(self,cookiename):
         # TODO: Is there a way to extract the value directly?
         for index, cookie in enumerate(self._cookieJar):
@@ -343,6 +493,17 @@ class GmailAccount:
     def _retrievePage(self, urlOrRequest):
         """
         """
+        resp = self._openPage(urlOrRequest)
+        if resp is None:
+            return None
+        # TODO: Enable logging of page data for debugging purposes?
+        return resp.read()
+
+    def _openPage(self, urlOrRequest):
+        """
+        Request a page and return the response, whose body has not been
+        read yet (or None on an HTTP error).
+        """
         if self.opener is None:
             raise "Cannot find urlopener"
         
@@ -355,65 +516,169 @@ class GmailAccount:
         req.add_header('User-Agent',
                        'Mozilla/5.0 (Compatible; libgmail-python)')
         
+        if self.rateLimiter is not None:
+            self.rateLimiter.acquire()
         try:
             resp = self.opener.open(req)
         except urllib2.HTTPError,info:
+            if self.rateLimiter is not None:
+                self.rateLimiter.record(info.code)
             print info
             return None
-        pageData = resp.read()
+        except IOError:
+            if self.rateLimiter is not None:
+                self.rateLimiter.record(None)
+            raise
+        if self.rateLimiter is not None:
+            self.rateLimiter.record(getattr(resp, 'code', 200))
 
         # TODO: This, for some reason, is still necessary?
         self._cookieJar.extract_cookies(resp, req)
 
-        # TODO: Enable logging of page data for debugging purposes?
-        return pageData
+        return resp
 
-    def _parsePage(self, urlOrRequest):
+    def _parsePage(self, urlOrRequest, cacheVersion = None):
         """
-        Retrieve & then parse the requested page content.
+        Retrieve & parse the requested page content. The page is parsed
+        while it is received, so it is never held in memory as a whole.
+
+        With a `responseCache`, pages of cacheable views are taken from
+        the cache while they are fresh, or stored in it otherwise.
+        `cacheVersion` is stored with the page, and must be the same for
+        the cached page to be used.
+        
+        """
+        cache = self.responseCache
+        if cache is not None and isinstance(urlOrRequest, basestring) \
+        and cache.cacheable(urlOrRequest):
+            cached = cache.get(self.name, urlOrRequest, cacheVersion)
+            if cached is not None:
+                try:
+                    items = _parseStream(cached)
+                finally:
+                    cached.close()
+                self._cacheItems(items)
+                return items
+        else:
+            cache = None
+
+        resp = self._openPage(urlOrRequest)
+        if resp is None:
+            raise GmailError, 'Failed to retrieve page from gmail.'
+        if cache is not None:
+            resp = cache.record(self.name, urlOrRequest, cacheVersion, resp)
+        try:
+            items = _parseStream(resp)
+            # Pages without data (e.g. errors) are not cached
+            if cache is not None and items:
+                resp.commit()
+        finally:
+            resp.close()
+        self._cacheItems(items)
+        return items
+
+
+    def _cacheItems(self, items):
+        """
+        Cache the account information found in parsed page `items`.
         
         """
-        items = _parsePage(self._retrievePage(urlOrRequest))
         # Automatically cache some things like quota usage.
         # TODO: Cache more?
-        # TODO: Expire cached values?
         # TODO: Do this better.
         try:
             self._cachedQuotaInfo = items[D_QUOTA]
         except KeyError:
             pass
+        else:
+            self._storeMetadata(gmail_cache.META_QUOTA, self._cachedQuotaInfo)
         #pprint.pprint(items)
         
         try:
-            self._cachedLabelNames = [category[CT_NAME] for category in items[D_CATEGORIES][0]]
+            categories = items[D_CATEGORIES][0]
         except KeyError:
             pass
-        
-        return items
+        else:
+            self._cachedLabelNames = [category[CT_NAME] for category in categories]
+            self._cachedLabelCounts = dict([(category[CT_NAME], category[CT_COUNT])
+                                            for category in categories])
+            self._storeMetadata(gmail_cache.META_LABEL_NAMES,
+                                self._cachedLabelNames)
+            self._storeMetadata(gmail_cache.META_LABEL_COUNTS,
+                                self._cachedLabelCounts)
+
+
+    def _storeMetadata(self, key, value):
+        """
+        Keep `value` in the `metadataCache`, if there is one.
+        """
+        if self.metadataCache is not None:
+            self.metadataCache.set(self.name, key, value)
+
+
+    def _loadMetadata(self, key):
+        """
+        Return the value of `key` from the `metadataCache`, or None if it
+        is not there (or has expired).
+        """
+        if self.metadataCache is None:
+            return None
+        return self.metadataCache.get(self.name, key)
 
 
     def _parseSearchResult(self, searchType, start = 0, **kwargs):
         """
         """
-        params = {U_SEARCH: searchType,
-                  U_START: start,
-                  U_VIEW: U_THREADLIST_VIEW,
-                  }
-        params.update(kwargs)
-        return self._parsePage(_buildURL(**params))
+        return self._parsePage(_buildSearchURL(searchType, start, **kwargs))
 
 
-    def _parseThreadSearch(self, searchType, allPages = False, **kwargs):
+    def _parseThreadSearch(self, searchType, allPages = False,
+                           knownThreads = None, knownRun = 0,
+                           lazy = False, prefetch = 0, **kwargs):
         """
 
         Only works for thread-based results at present. # TODO: Change this?
+
+        `knownThreads` -- Dictionary mapping thread ids to message counts.
+                          If given with `allPages`, no more pages are
+                          retrieved once `knownRun` consecutive threads
+                          with unchanged message counts have been seen.
+                          Threads are listed most recent first, so the
+                          remaining threads are unchanged as well.
+
+        `lazy` -- Return a `LazySearchResult`, which retrieves only the
+                  first page now and the other pages as they are needed
+                  (or up to `prefetch` pages ahead in the background).
+        """
+        pages = self._threadPages(searchType, allPages, knownThreads,
+                                  knownRun, **kwargs)
+        if lazy:
+            return LazySearchResult(self, (searchType, kwargs), pages,
+                                    prefetch)
+
+        threadsInfo = []
+        for threadListSummary, pageThreadsInfo in pages:
+            threadsInfo.extend(pageThreadsInfo)
+        
+        # TODO: Record whether or not we retrieved all pages..?
+        return GmailSearchResult(self, (searchType, kwargs), threadsInfo)
+
+
+    def _threadPages(self, searchType, allPages = False,
+                     knownThreads = None, knownRun = 0, **kwargs):
+        """
+        Generator that retrieves the pages of a thread search one at a
+        time, and yields the thread list summary and the (unbunched)
+        threads info of every page. See `_parseThreadSearch`.
         """
         start = 0
         tot = 0
-        threadsInfo = []
+        known = 0
+        numThreads = 0
         # Option to get *all* threads if multiple pages are used.
         while (start == 0) or (allPages and
-                               len(threadsInfo) < threadListSummary[TS_TOTAL]):
+                               numThreads < threadListSummary[TS_TOTAL]
+                               and not (knownRun and known >= knownRun)):
             
                 items = self._parseSearchResult(searchType, start, **kwargs)
                 #TODO: Handle single & zero result case better? Does this work?
@@ -422,18 +687,24 @@ class GmailAccount:
                 except KeyError:
                     break
                 else:
+                    threadsInfo = []
                     for th in threads:
                         if not type(th[0]) is types.ListType:
                             th = [th]
                         threadsInfo.append(th)
+                        if knownThreads and knownRun:
+                            if knownThreads.get(th[0][T_THREADID]) == \
+                               _threadLength(th[0][T_AUTHORS_HTML]):
+                                known += 1
+                            else:
+                                known = 0
+                    numThreads += len(threadsInfo)
                     # TODO: Check if the total or per-page values have changed?
                     threadListSummary = items[D_THREADLIST_SUMMARY][0]
                     threadsPerPage = threadListSummary[TS_NUM]
     
                     start += threadsPerPage
-        
-        # TODO: Record whether or not we retrieved all pages..?
-        return GmailSearchResult(self, (searchType, kwargs), threadsInfo)
+                    yield threadListSummary, threadsInfo
 
 
     def _retrieveJavascript(self, version = ""):
@@ -446,27 +717,40 @@ class GmailAccount:
                                             ver = version))
         
         
-    def getMessagesByFolder(self, folderName, allPages = False):
+    def getMessagesByFolder(self, folderName, allPages = False,
+                            knownThreads = None, knownRun = 0,
+                            lazy = False, prefetch = 0):
         """
 
         Folders contain conversation/message threads.
 
           `folderName` -- As set in Gmail interface.
 
+        See `_parseThreadSearch` for `knownThreads`, `knownRun`, `lazy`
+        and `prefetch`.
+
         Returns a `GmailSearchResult` instance.
 
         *** TODO: Change all "getMessagesByX" to "getThreadsByX"? ***
         """
-        return self._parseThreadSearch(folderName, allPages = allPages)
+        return self._parseThreadSearch(folderName, allPages = allPages,
+                                       knownThreads = knownThreads,
+                                       knownRun = knownRun,
+                                       lazy = lazy, prefetch = prefetch)
 
 
-    def getMessagesByQuery(self, query,  allPages = False):
+    def getMessagesByQuery(self, query,  allPages = False,
+                           knownThreads = None, knownRun = 0,
+                           lazy = False, prefetch = 0):
         """
 
         Returns a `GmailSearchResult` instance.
         """
         return self._parseThreadSearch(U_QUERY_SEARCH, q = query,
-                                       allPages = allPages)
+                                       allPages = allPages,
+                                       knownThreads = knownThreads,
+                                       knownRun = knownRun,
+                                       lazy = lazy, prefetch = prefetch)
 
     
     def getQuotaInfo(self, refresh = False):
@@ -475,6 +759,8 @@ class GmailAccount:
         Return MB used, Total MB and percentage used.
         """
         # TODO: Change this to a property.
+        if not self._cachedQuotaInfo and not refresh:
+            self._cachedQuotaInfo = self._loadMetadata(gmail_cache.META_QUOTA)
         if not self._cachedQuotaInfo or refresh:
             # TODO: Handle this better...
             self.getMessagesByFolder(U_INBOX_SEARCH)
@@ -486,18 +772,40 @@ class GmailAccount:
         """
         """
         # TODO: Change this to a property?
-        if not self._cachedLabelNames or refresh:
+        if self._cachedLabelNames is None and not refresh:
+            self._cachedLabelNames = \
+                self._loadMetadata(gmail_cache.META_LABEL_NAMES)
+        if self._cachedLabelNames is None or refresh:
             # TODO: Handle this better...
             self.getMessagesByFolder(U_INBOX_SEARCH)
 
         return self._cachedLabelNames
 
 
-    def getMessagesByLabel(self, label, allPages = False):
+    def getLabelCounts(self, refresh = False):
+        """
+        Return a dictionary mapping label names to the number of unread
+        conversations with the label.
+        """
+        if self._cachedLabelCounts is None and not refresh:
+            self._cachedLabelCounts = \
+                self._loadMetadata(gmail_cache.META_LABEL_COUNTS)
+        if self._cachedLabelCounts is None or refresh:
+            self.getMessagesByFolder(U_INBOX_SEARCH)
+
+        return self._cachedLabelCounts
+
+
+    def getMessagesByLabel(self, label, allPages = False,
+                           knownThreads = None, knownRun = 0,
+                           lazy = False, prefetch = 0):
         """
         """
         return self._parseThreadSearch(U_CATEGORY_SEARCH,
-                                       cat=label, allPages = allPages)
+                                       cat=label, allPages = allPages,
+                                       knownThreads = knownThreads,
+                                       knownRun = knownRun,
+                                       lazy = lazy, prefetch = prefetch)
     
     def getRawMessage(self, msgId):
         """
@@ -508,6 +816,15 @@ class GmailAccount:
         return self._retrievePage(
             _buildURL(view=PageView, th=msgId))
 
+    def openRawMessage(self, msgId):
+        """
+        Like `getRawMessage`, but return a file-like object from which the
+        message is read as it arrives, or None on an HTTP error. The
+        caller must close it.
+        """
+        return self._openPage(
+            _buildURL(view=U_ORIGINAL_MESSAGE_VIEW, th=msgId))
+
     def getUnreadMessages(self):
         """
         """
@@ -530,11 +847,17 @@ class GmailAccount:
     def _getActionToken(self):
         """
         """
-        try:
-            at = self.getCookie(ACTION_TOKEN_COOKIE)
-        except KeyError:
+        if self._cachedActionToken:
+            return self._cachedActionToken
+        at = self.getCookie(ACTION_TOKEN_COOKIE)
+        if not at:
+            at = self._loadMetadata(gmail_cache.META_ACTION_TOKEN)
+        if not at:
             self.getLabelNames(True) 
             at = self.getCookie(ACTION_TOKEN_COOKIE)
+        if at:
+            self._cachedActionToken = at
+            self._storeMetadata(gmail_cache.META_ACTION_TOKEN, at)
 
         return at
 
@@ -1209,6 +1532,7 @@ class GmailSearchResult:
         self._account = account
         self.search = search # TODO: Turn into object + format nicely.
         self._threads = []
+        self._sharedValues = {} # see `_intern`
         
         for thread in threadsInfo:
             self._threads.append(GmailThread(self, thread[0]))
@@ -1230,6 +1554,118 @@ class GmailSearchResult:
         return self._threads.__getitem__(key)
 
 
+class LazySearchResult(GmailSearchResult):
+    """
+    Search result whose pages of threads are retrieved as they are needed,
+    so that the first threads can be used while the listing goes on.
+
+    The first page is retrieved at once. Its summary gives the total
+    number of threads, which `len` returns until all pages have been
+    retrieved (a listing stopped early by `knownRun` has fewer threads).
+    Iteration retrieves the next page when it reaches the end of the
+    threads retrieved so far; indexing retrieves the pages up to the
+    index.
+    """
+
+    def __init__(self, account, search, pages, prefetch = 0):
+        """
+
+        `pages` -- Iterator of (thread list summary, threads info) for
+                   every page, as from `GmailAccount._threadPages`.
+
+        `prefetch` -- If non-zero, the pages are retrieved by a background
+                      thread, up to that many pages ahead of the threads
+                      used.
+        """
+        self._account = account
+        self.search = search
+        self._threads = []
+        self._sharedValues = {} # see `_intern`
+        if prefetch:
+            pages = _prefetchPages(pages, prefetch)
+        self._pages = pages
+        self._total = 0
+        self._nextPage()
+
+
+    def _nextPage(self):
+        """
+        Add the threads of the next page. Returns False if there are no
+        more pages.
+        """
+        if self._pages is None:
+            return False
+        try:
+            threadListSummary, threadsInfo = self._pages.next()
+        except StopIteration:
+            self._pages = None
+            return False
+        self._total = threadListSummary[TS_TOTAL]
+        for thread in threadsInfo:
+            self._threads.append(GmailThread(self, thread[0]))
+        return True
+
+
+    def __iter__(self):
+        """
+        """
+        index = 0
+        while index < len(self._threads) or self._nextPage():
+            yield self._threads[index]
+            index += 1
+
+    def __len__(self):
+        """
+        """
+        if self._pages is None:
+            return len(self._threads)
+        return max(self._total, len(self._threads))
+
+    def __getitem__(self, key):
+        """
+        """
+        if isinstance(key, slice):
+            needed = key.stop
+        else:
+            needed = key + 1
+        if needed is None or needed <= 0:
+            # Counted from the end
+            while self._nextPage():
+                pass
+        else:
+            while len(self._threads) < needed and self._nextPage():
+                pass
+        return self._threads.__getitem__(key)
+
+
+def _prefetchPages(pages, depth):
+    """
+    Generator of the items of the iterator `pages`, which are retrieved
+    by a background thread up to `depth` items ahead. Exceptions of
+    `pages` are raised by the generator.
+    """
+    queue = Queue.Queue(depth)
+    def retrieve():
+        try:
+            for page in pages:
+                queue.put((page, None))
+        except:
+            queue.put((None, sys.exc_info()))
+        else:
+            queue.put((None, None))
+    retriever = threading.Thread(target = retrieve)
+    # Don't keep the process alive for a listing nobody uses any more
+    retriever.setDaemon(True)
+    retriever.start()
+    while True:
+        page, excInfo = queue.get()
+        if excInfo is not None:
+            raise excInfo[0], excInfo[1], excInfo[2]
+        if page is None:
+            return
+        yield page
+
+
 class GmailSessionState:
     """
     """
@@ -1248,8 +1684,18 @@ class GmailSessionState:
 
     def save(self, filename):
         """
+        Save the state to `filename`, readable only by the user. The file
+        is replaced atomically, so it never holds a partial state.
         """
-        dump(self.state, open(filename, "wb"), -1)
+        tmpfile = "%s.tmp%s" % (filename, os.getpid())
+        stateFile = os.fdopen(os.open(tmpfile,
+                                      os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                      0600), "wb")
+        try:
+            dump(self.state, stateFile, -1)
+        finally:
+            stateFile.close()
+        os.rename(tmpfile, filename)
 
 
 class _LabelHandlerMixin(object):
@@ -1258,11 +1704,20 @@ class _LabelHandlerMixin(object):
     Note: Because a message id can be used as a thread id this works for
           messages as well as threads.
     """
+    __slots__ = ('_labels',)
+
     def __init__(self):
         self._labels = None
         
     def _makeLabelList(self, labelList):
-        self._labels = labelList
+        # Many threads have the same labels, so they share one tuple.
+        if labelList is None:
+            self._labels = None
+        else:
+            sharedValues = getattr(self, '_sharedValues', None)
+            self._labels = _intern(sharedValues,
+                                   tuple([_intern(sharedValues, label)
+                                          for label in labelList]))
     
     def addLabel(self, labelName):
         """
@@ -1270,10 +1725,8 @@ class _LabelHandlerMixin(object):
         # Note: It appears this also automatically creates new labels.
         result = self._account._doThreadAction(U_ADDCATEGORY_ACTION+labelName,
                                                self)
-        if not self._labels:
-            self._makeLabelList([])
         # TODO: Caching this seems a little dangerous; suppress duplicates maybe?
-        self._labels.append(labelName)
+        self._makeLabelList((self._labels or ()) + (labelName,))
         return result
 
 
@@ -1287,17 +1740,21 @@ class _LabelHandlerMixin(object):
                                              self)
         
         removeLabel = True
+        labels = list(self._labels or ())
         try:
-            self._labels.remove(labelName)
+            labels.remove(labelName)
         except:
             removeLabel = False
             pass
+        self._makeLabelList(labels)
     
         # If we don't check both, we might end up in some weird inconsistent state
         return result and removeLabel
 
     def getLabels(self):
-        return self._labels
+        if self._labels is None:
+            return None
+        return list(self._labels)
     
 
 
@@ -1307,9 +1764,17 @@ class GmailThread(_LabelHandlerMixin):
           as the id of the last message in the thread. But it appears that
           the id of any message in the thread can be used to retrieve
           the thread information.
+
+    A listing can have hundreds of thousands of threads, so only the
+    fields of the thread list entry are kept (in slots, without the entry
+    itself), and recurring values are shared between threads.
     
     """
 
+    __slots__ = ('_parent', '_account', 'id', 'subject', 'snippet',
+                 'authors', 'unread', 'star', 'date', 'flags', 'attach',
+                 'matching_msgid', 'extra_snippet', '_length', '_messages')
+
     def __init__(self, parent, threadsInfo):
         """
         """
@@ -1325,20 +1790,20 @@ class GmailThread(_LabelHandlerMixin):
         self.snippet = threadsInfo[T_SNIPPET_HTML]
         #self.extraSummary = threadInfo[T_EXTRA_SNIPPET] #TODO: What is this?
 
+        self.authors = threadsInfo[T_AUTHORS_HTML]
+        self.unread = threadsInfo[T_UNREAD]
+        self.star = threadsInfo[T_STAR]
+        self.date = _intern(self._sharedValues, threadsInfo[T_DATE_HTML])
+        self.flags = threadsInfo[T_FLAGS]
+        # Not all entries have these
+        optional = threadsInfo[T_ATTACH_HTML:T_EXTRA_SNIPPET + 1]
+        optional += [None] * (T_EXTRA_SNIPPET + 1 - T_ATTACH_HTML
+                              - len(optional))
+        self.attach, self.matching_msgid, self.extra_snippet = optional
+
         # TODO: Store other info?
         # Extract number of messages in thread/conversation.
-
-        self._authors = threadsInfo[T_AUTHORS_HTML]
-        self.info = threadsInfo
-    
-        try:
-            # TODO: Find out if this information can be found another way...
-            #       (Without another page request.)
-            self._length = int(re.search("\((\d+?)\)\Z",
-                                         self._authors).group(1))
-        except AttributeError,info:
-            # If there's no message count then the thread only has one message.
-            self._length = 1
+        self._length = _threadLength(self.authors)
 
         # TODO: Store information known about the last message  (e.g. id)?
         self._messages = []
@@ -1346,25 +1811,37 @@ class GmailThread(_LabelHandlerMixin):
         # Populate labels
         self._makeLabelList(threadsInfo[T_CATEGORIES])
 
-    def __getattr__(self, name):
-        """
-        Dynamically dispatch some interesting thread properties.
-        """
-        attrs = { 'unread': T_UNREAD,
-                  'star': T_STAR,
-                  'date': T_DATE_HTML,
-                  'authors': T_AUTHORS_HTML,
-                  'flags': T_FLAGS,
-                  'subject': T_SUBJECT_HTML,
-                  'snippet': T_SNIPPET_HTML,
-                  'categories': T_CATEGORIES,
-                  'attach': T_ATTACH_HTML,
-                  'matching_msgid': T_MATCHING_MSGID,
-                  'extra_snippet': T_EXTRA_SNIPPET }
-        if name in attrs:
-            return self.info[ attrs[name] ];
-
-        raise AttributeError("no attribute %s" % name)
+    categories = property(_LabelHandlerMixin.getLabels,
+                          doc = "The labels of the thread.")
+
+    def _getSharedValues(self):
+        return getattr(self._parent, '_sharedValues', None)
+
+    _sharedValues = property(_getSharedValues,
+                             doc = "The shared values of the listing.")
+
+    def _getInfo(self):
+        info = [None] * (T_EXTRA_SNIPPET + 1)
+        info[T_THREADID] = self.id
+        info[T_UNREAD] = self.unread
+        info[T_STAR] = self.star
+        info[T_DATE_HTML] = self.date
+        info[T_AUTHORS_HTML] = self.authors
+        info[T_FLAGS] = self.flags
+        info[T_SUBJECT_HTML] = self.subject
+        info[T_SNIPPET_HTML] = self.snippet
+        info[T_CATEGORIES] = self.getLabels()
+        info[T_ATTACH_HTML] = self.attach
+        info[T_MATCHING_MSGID] = self.matching_msgid
+        info[T_EXTRA_SNIPPET] = self.extra_snippet
+        # Not all entries have the optional fields
+        while len(info) > T_ATTACH_HTML and info[-1] is None:
+            info.pop()
+        return info
+
+    info = property(_getInfo,
+                    doc = "The thread list entry of the thread (rebuilt "
+                          "from its fields; read-only).")
         
     def __len__(self):
         """
@@ -1375,48 +1852,74 @@ class GmailThread(_LabelHandlerMixin):
     def __iter__(self):
         """
         """
-        if not self._messages:
-            self._messages = self._getMessages(self)
+        self.loadMessages()
             
         return iter(self._messages)
 
     def __getitem__(self, key):
         """
         """
-        if not self._messages:
-            self._messages = self._getMessages(self)
+        self.loadMessages()
         try:
             result = self._messages.__getitem__(key)
         except IndexError:
             result = []
         return result
 
+    def loadMessages(self):
+        """
+        Retrieve the messages of the thread, unless they have been
+        retrieved already.
+        """
+        if not self._messages:
+            self._messages = self._getMessages(self)
+
     def _getMessages(self, thread):
         """
         """
         # TODO: Do this better.
         # TODO: Specify the query folder using our specific search?
-        items = self._account._parseSearchResult(U_QUERY_SEARCH,
-                                                 view = U_CONVERSATION_VIEW,
-                                                 th = thread.id,
-                                                 q = "in:anywhere")
-        result = []
-        # TODO: Handle this better?
-        # Note: This handles both draft & non-draft messages in a thread...
-        for key, isDraft in [(D_MSGINFO, False), (D_DRAFTINFO, True)]:
-            try:
-                msgsInfo = items[key]
-            except KeyError:
-                # No messages of this type (e.g. draft or non-draft)
-                continue
-            else:
-                # TODO: Handle special case of only 1 message in thread better?
-                if type(msgsInfo[0]) != types.ListType:
-                    msgsInfo = [msgsInfo]
-                for msg in msgsInfo:
-                    result += [GmailMessage(thread, msg, isDraft = isDraft)]
-                           
-        return result
+        # The conversation only changes when messages are added to it, so a
+        # cached copy is used as long as the number of messages is the same.
+        items = self._account._parsePage(
+            _buildSearchURL(U_QUERY_SEARCH, view = U_CONVERSATION_VIEW,
+                            th = thread.id, q = "in:anywhere"),
+            cacheVersion = len(thread))
+        return _messagesFromItems(thread, items)
+
+
+def _messagesFromItems(thread, items):
+    """
+    Build the `GmailMessage` instances of `thread` from the parsed
+    conversation view `items`.
+    """
+    result = []
+    # TODO: Handle this better?
+    # Note: This handles both draft & non-draft messages in a thread...
+    for key, isDraft in [(D_MSGINFO, False), (D_DRAFTINFO, True)]:
+        try:
+            msgsInfo = items[key]
+        except KeyError:
+            # No messages of this type (e.g. draft or non-draft)
+            continue
+        else:
+            # TODO: Handle special case of only 1 message in thread better?
+            if type(msgsInfo[0]) != types.ListType:
+                msgsInfo = [msgsInfo]
+            for msg in msgsInfo:
+                result += [GmailMessage(thread, msg, isDraft = isDraft)]
+
+    return result
+
+
+def _addressList(sharedValues, addresses):
+    """
+    Return the shared tuple of the (shared) `addresses`.
+    """
+    return _intern(sharedValues,
+                   tuple([_intern(sharedValues, to_unicode(address))
+                          for address in addresses]))
+
 
 class GmailMessageStub(_LabelHandlerMixin):
     """
@@ -1440,7 +1943,14 @@ class GmailMessageStub(_LabelHandlerMixin):
         
 class GmailMessage(object):
     """
+
+    Addresses are shared between messages (see `_intern`), and the
+    address lists are tuples.
     """
+
+    __slots__ = ('_parent', '_account', 'author', 'author_fullname', 'id',
+                 'number', 'subject', 'date', 'to', 'cc', 'bcc', 'sender',
+                 'attachments', 'isDraft', '_source')
     
     def __init__(self, parent, msgData, isDraft = False):
         """
@@ -1451,16 +1961,21 @@ class GmailMessage(object):
         # TODO Handle this better?
         self._parent = parent
         self._account = self._parent._account
+        sharedValues = getattr(parent, '_sharedValues', None)
         
-        self.author = to_unicode(msgData[MI_AUTHORFIRSTNAME])
-        self.author_fullname = to_unicode(msgData[MI_AUTHORNAME])
+        self.author = _intern(sharedValues,
+                              to_unicode(msgData[MI_AUTHORFIRSTNAME]))
+        self.author_fullname = _intern(sharedValues,
+                                       to_unicode(msgData[MI_AUTHORNAME]))
         self.id = msgData[MI_MSGID]
         self.number = msgData[MI_NUM]
         self.subject = to_unicode(msgData[MI_SUBJECT])
-        self.to = [to_unicode(x) for x in msgData[MI_TO]]
-        self.cc = [to_unicode(x) for x in msgData[MI_CC]]
-        self.bcc = [to_unicode(x) for x in msgData[MI_BCC]]
-        self.sender = to_unicode(msgData[MI_AUTHOREMAIL])
+        self.date = to_unicode(msgData[MI_DATE])
+        self.to = _addressList(sharedValues, msgData[MI_TO])
+        self.cc = _addressList(sharedValues, msgData[MI_CC])
+        self.bcc = _addressList(sharedValues, msgData[MI_BCC])
+        self.sender = _intern(sharedValues,
+                              to_unicode(msgData[MI_AUTHOREMAIL]))
         
         # Messages created by google chat (from reply with chat, etc.)
         # don't have any attachments, so we need this check not to choke
@@ -1491,6 +2006,16 @@ class GmailMessage(object):
         return self._source
 
     source = property(_getSource, doc = "")
+
+    def openSource(self):
+        """
+        Return a file-like object for reading the raw message, which is
+        not kept in memory (unless `source` has been used before). The
+        caller must close it.
+        """
+        if self._source:
+            return StringIO(self._source)
+        return self._account.openRawMessage(self.id)
         
 
 
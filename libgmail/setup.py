@@ -6,7 +6,8 @@
 # To install to your system; python setup.py install
 import libgmail
 from distutils.core import setup
-mods = ['libgmail','lgconstants','gmail_transport']
+mods = ['libgmail','lgconstants','gmail_transport','gmail_async',
+        'gmail_parser','gmail_cache']
 setup (name = "libgmail",
        version = "%s" % libgmail.Version,
        description = "python bindings to access Gmail",